@@ -0,0 +1,102 @@
+"""Compare the single pass note analysis (notes.analysis.analyse_note) with
+the three pass tag extraction it replaced.
+
+Usage: python benchmarks/analysis.py [--notes 2000] [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from notes.analysis import analyse_note  # noqa: E402
+
+TAGS_RE = re.compile(r"(?:(?<=^#)|(?<=\s#))[a-zA-Z0-9_-]+(?=\s|$)")
+CODEBLOCK_RE = re.compile(r"`{1,3}.*?`{1,3}", re.DOTALL)
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog note idea meeting project "
+    + "café résumé naïve façade"
+).split()
+
+
+def re_extract(pattern, string):
+    matches = []
+    text = re.sub(pattern, lambda tag: matches.append(tag.group()), string)
+    return (text, matches)
+
+
+def three_pass_extract_tags(content):
+    """The previous implementation of FileSystemNotes._extract_tags."""
+    content_ex_codeblock = re.sub(CODEBLOCK_RE, "", content)
+    _, tags = re_extract(TAGS_RE, content_ex_codeblock)
+    content_ex_tags, _ = re_extract(TAGS_RE, content)
+    tags = [tag.lower() for tag in tags]
+    return (content_ex_tags, set(tags))
+
+
+def generate_note(rng: random.Random) -> str:
+    lines = [f"# {rng.choice(WORDS).title()} {rng.randint(1, 999)}"]
+    for _ in range(rng.randint(5, 60)):
+        choice = rng.random()
+        if choice < 0.1:
+            lines.append(f"## {rng.choice(WORDS).title()}")
+        elif choice < 0.15:
+            lines.append("```\n#include <stdio.h>\nint main() {}\n```")
+        else:
+            words = [rng.choice(WORDS) for _ in range(rng.randint(5, 25))]
+            if rng.random() < 0.3:
+                words.append(f"#tag{rng.randint(0, 50)}")
+            if rng.random() < 0.2:
+                words.append(f"[[{rng.choice(WORDS).title()}]]")
+            if rng.random() < 0.2:
+                words.insert(rng.randrange(len(words)), "`inline`")
+            lines.append(" ".join(words))
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    notes = [generate_note(rng) for _ in range(args.notes)]
+    size_mb = sum(len(note) for note in notes) / 1024 / 1024
+
+    for note in notes:
+        content_ex_tags, tags = three_pass_extract_tags(note)
+        analysis = analyse_note(note)
+        assert analysis.content_ex_tags == content_ex_tags
+        assert analysis.tags == tags
+
+    print(f"{args.notes} notes ({size_mb:.1f} MB), best of {args.repeat}")
+    results = {}
+    for name, func in (
+        ("three pass", three_pass_extract_tags),
+        ("single pass", analyse_note),
+    ):
+        seconds = min(
+            timeit.repeat(
+                lambda: [func(note) for note in notes],
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        results[name] = seconds
+        print(
+            f"{name:>12}: {seconds * 1000:8.1f} ms "
+            + f"({seconds / args.notes * 1e6:6.1f} us/note)"
+        )
+    speedup = results["three pass"] / results["single pass"]
+    print(f"     speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
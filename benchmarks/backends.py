@@ -0,0 +1,102 @@
+"""Compare the Whoosh and SQLite search backends using the benchmark suite.
+
+The suite (suite.py) is run for each backend, in a separate process, against
+the same synthetic corpus. Any arguments not listed below are passed on to
+the suite e.g. --notes, --median-words or --no-highlights.
+
+Usage: python benchmarks/backends.py [--notes 10000] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional
+
+from results import save_results
+
+BACKENDS = ("whoosh", "sqlite")
+SUITE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "suite.py")
+# The results that are compared, as paths into the results of the suite
+SUMMARY = (
+    ("cold build (s)", ("cold_build", "s")),
+    ("index size (MB)", ("cold_build", "index_bytes")),
+    ("warm sync p50 (ms)", ("warm_sync", "p50_ms")),
+    ("search score p50 (ms)", ("search", "score", "p50_ms")),
+    ("search score p99 (ms)", ("search", "score", "p99_ms")),
+    ("search title p50 (ms)", ("search", "title", "p50_ms")),
+    ("search last_modified p50 (ms)", ("search", "last_modified", "p50_ms")),
+    ("get tags p50 (ms)", ("get_tags", "p50_ms")),
+    ("create (ops/s)", ("writes", "create", "ops_per_s")),
+    ("update (ops/s)", ("writes", "update", "ops_per_s")),
+    ("delete (ops/s)", ("writes", "delete", "ops_per_s")),
+)
+
+
+def run_suite(backend: str, suite_args: List[str]) -> dict:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output = os.path.join(temp_dir, "results.json")
+        subprocess.run(
+            [
+                sys.executable,
+                SUITE,
+                *suite_args,
+                "--backend",
+                backend,
+                "--output",
+                output,
+            ],
+            check=True,
+        )
+        with open(output, encoding="utf-8") as f:
+            return json.load(f)["results"]
+
+
+def lookup(results: dict, path: tuple) -> Optional[float]:
+    for key in path:
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    if path[-1] == "index_bytes":
+        return round(results / 1024 / 1024, 1)
+    return results
+
+
+def print_summary(results: Dict[str, dict]) -> None:
+    width = max(len(name) for name, _ in SUMMARY)
+    print("".ljust(width), *(backend.rjust(10) for backend in results))
+    for name, path in SUMMARY:
+        values = [lookup(results[backend], path) for backend in results]
+        print(
+            name.ljust(width),
+            *(
+                str("-" if value is None else value).rjust(10)
+                for value in values
+            ),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS)
+    )
+    parser.add_argument("--output", help="Write the results as JSON.")
+    args, suite_args = parser.parse_known_args()
+    # Note: --compare is passed on to the suite for each backend
+    args.compare = None
+
+    results = {}
+    for backend in args.backends:
+        print(f"Benchmarking the {backend} backend")
+        results[backend] = run_suite(backend, suite_args)
+    print()
+    print_summary(results)
+    args.suite_args = suite_args
+    save_results(args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Generate a deterministic, synthetic corpus of notes for benchmarking.
+
+The same arguments (including the seed) always produce the same notes,
+including their modification times. Note lengths follow a log-normal
+distribution and notes include headings, tags, wikilinks, code blocks and
+accented words (to exercise the accent folding analyzer).
+
+Usage: python benchmarks/corpus.py PATH [--notes 1000] [--median-words 150]
+"""
+
+import argparse
+import math
+import os
+import random
+from dataclasses import dataclass
+from typing import Iterator, List, Tuple
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog note idea meeting project plan "
+    + "review design draft summary budget travel recipe garden book music "
+    + "python server index search query result cache thread worker process "
+    + "morning evening weekly monthly research paper reading list todo done "
+    + "running runner runs ran connection connected connecting connects"
+).split()
+ACCENTED_WORDS = (
+    "café résumé naïve façade crème brûlée jalapeño señor über fiancée "
+    + "déjà vu coöperate smörgåsbord piñata"
+).split()
+CODE_BLOCKS = (
+    "```python\ndef main():\n    print('hello #notatag')\n```",
+    "```\n#include <stdio.h>\nint main() { return 0; }\n```",
+    "```sh\necho $HOME # comment\n```",
+)
+# Modification times start here and are spread over the following year
+BASE_MTIME = 1704067200  # 2024-01-01T00:00:00Z
+
+
+@dataclass
+class CorpusOptions:
+    notes: int = 1000
+    median_words: int = 150
+    # The sigma of the log-normal distribution of words per note. Larger
+    # values give a longer tail of very large notes.
+    sigma: float = 1.0
+    tags: int = 200
+    tag_probability: float = 0.3
+    code_probability: float = 0.05
+    accent_probability: float = 0.05
+    seed: int = 0
+
+
+def title_for(index: int) -> str:
+    return f"Note {index:06d}"
+
+
+def generate_note(
+    rng: random.Random, index: int, options: CorpusOptions
+) -> Tuple[str, str]:
+    """Return the title and content of a note."""
+    word_count = max(
+        1,
+        int(rng.lognormvariate(math.log(options.median_words), options.sigma)),
+    )
+    lines: List[str] = [f"# {rng.choice(WORDS).title()} {index}"]
+    written = 0
+    while written < word_count:
+        choice = rng.random()
+        if choice < 0.08:
+            lines.append(f"## {rng.choice(WORDS).title()}")
+        elif choice < 0.08 + options.code_probability:
+            lines.append(rng.choice(CODE_BLOCKS))
+        else:
+            count = min(rng.randint(5, 25), word_count - written)
+            words = rng.choices(WORDS, k=count)
+            if rng.random() < options.accent_probability * 5:
+                words[rng.randrange(count)] = rng.choice(ACCENTED_WORDS)
+            if rng.random() < options.tag_probability:
+                words.append(f"#tag{rng.randrange(options.tags)}")
+            if rng.random() < 0.1:
+                words.append(f"[[{title_for(rng.randrange(options.notes))}]]")
+            lines.append(" ".join(words))
+            written += count
+    return title_for(index), "\n\n".join(lines) + "\n"
+
+
+def iter_corpus(options: CorpusOptions) -> Iterator[Tuple[str, str, int]]:
+    """Yield the title, content and modification time of each note."""
+    rng = random.Random(options.seed)
+    for index in range(options.notes):
+        title, content = generate_note(rng, index, options)
+        mtime = BASE_MTIME + rng.randrange(365 * 24 * 60 * 60)
+        yield title, content, mtime
+
+
+def write_corpus(path: str, options: CorpusOptions) -> int:
+    """Write the corpus to the given directory and return its total size in
+    bytes."""
+    os.makedirs(path, exist_ok=True)
+    total = 0
+    for title, content, mtime in iter_corpus(options):
+        filepath = os.path.join(path, title + ".md")
+        with open(filepath, "w", encoding="utf-8", newline="") as f:
+            total += f.write(content)
+        os.utime(filepath, (mtime, mtime))
+    return total
+
+
+def add_corpus_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = CorpusOptions()
+    parser.add_argument("--notes", type=int, default=defaults.notes)
+    parser.add_argument(
+        "--median-words", type=int, default=defaults.median_words
+    )
+    parser.add_argument("--sigma", type=float, default=defaults.sigma)
+    parser.add_argument("--tags", type=int, default=defaults.tags)
+    parser.add_argument(
+        "--tag-probability", type=float, default=defaults.tag_probability
+    )
+    parser.add_argument(
+        "--code-probability", type=float, default=defaults.code_probability
+    )
+    parser.add_argument(
+        "--accent-probability",
+        type=float,
+        default=defaults.accent_probability,
+    )
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def corpus_options_from_args(args: argparse.Namespace) -> CorpusOptions:
+    return CorpusOptions(
+        notes=args.notes,
+        median_words=args.median_words,
+        sigma=args.sigma,
+        tags=args.tags,
+        tag_probability=args.tag_probability,
+        code_probability=args.code_probability,
+        accent_probability=args.accent_probability,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    size = write_corpus(args.path, corpus_options_from_args(args))
+    print(f"Wrote {args.notes} notes ({size / 1024 / 1024:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
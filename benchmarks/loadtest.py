@@ -0,0 +1,506 @@
+"""Load test the API with a mix of concurrent, authenticated requests.
+
+By default, the app is run in-process (using httpx's ASGI transport) against
+a temporary notes directory containing a synthetic corpus (see corpus.py).
+Note that the load is then generated on the same event loop as the app is
+run on. Use --uvicorn to run the app in a separate uvicorn process instead,
+or --url to test an instance that is already running. The client must have
+been built (client/dist) for the app to start.
+
+Each of --concurrency workers sends requests, chosen at random according to
+--mix, one after another for --duration seconds. Throughput, latency
+percentiles and the status of every response are reported per operation.
+Index lock retries are read from the metrics endpoint, if it is enabled.
+
+Usage: python benchmarks/loadtest.py [--uvicorn | --url URL] [--mix ...]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import quote
+
+import httpx
+
+SERVER_DIR = os.path.join(os.path.dirname(__file__), "..", "server")
+sys.path.insert(0, SERVER_DIR)
+
+from corpus import (  # noqa: E402
+    ACCENTED_WORDS,
+    WORDS,
+    add_corpus_arguments,
+    corpus_options_from_args,
+    write_corpus,
+)
+from results import (  # noqa: E402
+    add_output_arguments,
+    percentiles,
+    save_results,
+)
+
+ROOT_DIR = os.path.abspath(os.path.join(SERVER_DIR, ".."))
+SORTS = ("score", "title", "lastModified")
+SCRATCH_TITLE = "Load Test {:04d}"
+ATTACHMENT_FILENAME = "load-test-{:04d}.bin"
+LOCK_RETRIES_RE = re.compile(
+    r"^flatnotes_index_lock_retries_total(?:\{[^}]*\})? (\S+)$", re.MULTILINE
+)
+# Settings that affect the results and are recorded with them
+RECORDED_ENV = (
+    "FLATNOTES_INDEX_WORKERS",
+    "FLATNOTES_WATCH_MODE",
+    "FLATNOTES_INDEX_COMMIT_DELAY_MS",
+    "FLATNOTES_SEARCH_THREADS",
+    "FLATNOTES_SEARCH_CACHE_RESULTS",
+    "FLATNOTES_SEARCH_BACKEND",
+)
+
+
+class Context:
+    """What the operations need to know about the instance under test."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.titles: List[str] = []
+        # The number of notes in a generated corpus
+        self.expected_notes: Optional[int] = None
+        self.scratch_titles = [
+            SCRATCH_TITLE.format(index) for index in range(args.scratch_notes)
+        ]
+        self.attachments = [
+            ATTACHMENT_FILENAME.format(index)
+            for index in range(args.attachments)
+        ]
+
+
+Operation = Callable[
+    [httpx.AsyncClient, random.Random, Context], Awaitable[httpx.Response]
+]
+
+
+async def search(client, rng, context):
+    return await client.get(
+        "api/search",
+        params={
+            "term": rng.choice(
+                WORDS + ACCENTED_WORDS + ["#tag1", "#tag2 project"]
+            ),
+            "sort": rng.choice(SORTS),
+            "limit": context.args.search_limit,
+        },
+    )
+
+
+async def get_note(client, rng, context):
+    return await client.get(f"api/notes/{quote(rng.choice(context.titles))}")
+
+
+async def patch_note(client, rng, context):
+    return await client.patch(
+        f"api/notes/{quote(rng.choice(context.scratch_titles))}",
+        json={
+            "newContent": " ".join(rng.choices(WORDS, k=50))
+            + f" #tag{rng.randrange(10)}"
+        },
+    )
+
+
+async def get_attachment(client, rng, context):
+    return await client.get(
+        f"api/attachments/{rng.choice(context.attachments)}"
+    )
+
+
+async def get_tags(client, rng, context):
+    return await client.get("api/tags")
+
+
+OPERATIONS: Dict[str, Operation] = {
+    "search": search,
+    "get": get_note,
+    "patch": patch_note,
+    "attachment": get_attachment,
+    "tags": get_tags,
+}
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Parse a traffic mix e.g. "search=50,get=50" into weights."""
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                f"Unknown operation '{name}'. "
+                + f"Must be one of: {', '.join(OPERATIONS)}."
+            )
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid weight for '{name}'")
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("At least one weight must be > 0")
+    return mix
+
+
+class Stats:
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+
+    def record(self, name: str, status: str, duration: float) -> None:
+        self.durations[name].append(duration)
+        self.statuses[name][status] += 1
+
+    def summary(self, duration: float, lock_retries: Optional[int]) -> dict:
+        statuses = sum(self.statuses.values(), Counter())
+        requests = sum(statuses.values())
+        errors = sum(
+            count
+            for status, count in statuses.items()
+            if not is_success(status)
+        )
+        return {
+            "requests": requests,
+            "duration_s": round(duration, 3),
+            "requests_per_s": round(requests / duration, 1),
+            "error_rate": round(errors / requests, 4) if requests else 0,
+            "unauthorized": statuses.get("401", 0),
+            "server_errors": sum(
+                count
+                for status, count in statuses.items()
+                if status.startswith("5")
+            ),
+            "index_lock_retries": lock_retries,
+            "latency": percentiles(
+                [d for durations in self.durations.values() for d in durations]
+            ),
+            "operations": {
+                name: {
+                    "requests": len(durations),
+                    "latency": percentiles(durations),
+                    "statuses": dict(self.statuses[name]),
+                }
+                for name, durations in sorted(self.durations.items())
+            },
+        }
+
+
+def is_success(status: str) -> bool:
+    return status.startswith("2") or status == "304"
+
+
+async def worker(
+    client: httpx.AsyncClient,
+    context: Context,
+    mix: Dict[str, float],
+    seed: int,
+    deadline: float,
+    stats: Stats,
+) -> None:
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = list(mix.values())
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        start_time = time.perf_counter()
+        try:
+            response = await OPERATIONS[name](client, rng, context)
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        stats.record(name, status, time.perf_counter() - start_time)
+
+
+async def authenticate(client: httpx.AsyncClient, args) -> None:
+    """Add an Authorization header to the client if required."""
+    token = args.token
+    if token is None:
+        response = await client.get("api/config")
+        response.raise_for_status()
+        auth_type = response.json()["authType"]
+        if auth_type == "totp":
+            sys.exit("TOTP authentication is enabled. Use --token.")
+        if auth_type not in ("none", "read_only"):
+            response = await client.post(
+                "api/token",
+                json={"username": args.username, "password": args.password},
+            )
+            if response.status_code != 200:
+                sys.exit(f"Failed to log in ({response.status_code})")
+            token = response.json()["access_token"]
+    if token is not None:
+        client.headers["Authorization"] = f"Bearer {token}"
+    response = await client.get("api/auth-check")
+    if response.status_code != 200:
+        sys.exit(f"Failed to authenticate ({response.status_code})")
+
+
+async def prepare(client: httpx.AsyncClient, context: Context) -> None:
+    """Find the existing notes and create the scratch notes and attachments
+    used by the operations. If the number of notes is known, wait for them
+    all to be indexed: when running multiple workers, those that don't
+    maintain the index start before it has been built."""
+    deadline = time.monotonic() + context.args.startup_timeout
+    while True:
+        response = await client.get(
+            "api/search",
+            params={"term": "*", "limit": 10000, "highlights": "false"},
+        )
+        response.raise_for_status()
+        context.titles = [result["title"] for result in response.json()]
+        if (
+            context.expected_notes is None
+            or len(context.titles) >= context.expected_notes
+            or time.monotonic() > deadline
+        ):
+            break
+        await asyncio.sleep(0.5)
+    for title in context.scratch_titles:
+        response = await client.post(
+            "api/notes", json={"title": title, "content": "Load test"}
+        )
+        if response.status_code not in (200, 409):
+            response.raise_for_status()
+    if not context.titles:
+        context.titles = context.scratch_titles
+    content = os.urandom(context.args.attachment_kb * 1024)
+    for filename in context.attachments:
+        response = await client.post(
+            "api/attachments",
+            params={"filename": filename},
+            content=content,
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        if response.status_code not in (200, 409):
+            response.raise_for_status()
+
+
+async def clean_up(client: httpx.AsyncClient, context: Context) -> None:
+    # Note: Attachments can't be deleted using the API
+    for title in context.scratch_titles:
+        await client.delete(f"api/notes/{quote(title)}")
+
+
+async def lock_retries(client: httpx.AsyncClient) -> Optional[int]:
+    """Return the total index lock retries from the metrics endpoint, or None
+    if it isn't enabled."""
+    response = await client.get("metrics")
+    if response.status_code != 200:
+        return None
+    return int(
+        sum(float(value) for value in LOCK_RETRIES_RE.findall(response.text))
+    )
+
+
+async def run(
+    args: argparse.Namespace,
+    transport: Optional[httpx.AsyncBaseTransport],
+    local: bool,
+) -> dict:
+    mix = args.mix
+    context = Context(args)
+    if local:
+        context.expected_notes = args.notes
+    if not mix.get("patch"):
+        context.scratch_titles = []
+    limits = httpx.Limits(
+        max_connections=args.concurrency,
+        max_keepalive_connections=args.concurrency,
+    )
+    async with httpx.AsyncClient(
+        base_url=args.url.rstrip("/") + "/",
+        transport=transport,
+        limits=limits,
+        timeout=args.timeout,
+    ) as client:
+        await authenticate(client, args)
+        await prepare(client, context)
+        print(
+            f"Found {len(context.titles)} notes, running "
+            + f"{args.concurrency} workers for {args.duration} s"
+        )
+        retries_before = await lock_retries(client)
+        stats = Stats()
+        start_time = time.perf_counter()
+        deadline = start_time + args.duration
+        await asyncio.gather(
+            *(
+                worker(
+                    client, context, mix, args.seed + index, deadline, stats
+                )
+                for index in range(args.concurrency)
+            )
+        )
+        duration = time.perf_counter() - start_time
+        retries_after = await lock_retries(client)
+        await clean_up(client, context)
+    retries = (
+        retries_after - retries_before
+        if retries_before is not None and retries_after is not None
+        else None
+    )
+    return stats.summary(duration, retries)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(args: argparse.Namespace) -> subprocess.Popen:
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--app-dir",
+            "server",
+            "--port",
+            str(port),
+            "--workers",
+            str(args.workers),
+            "--no-access-log",
+        ],
+        cwd=ROOT_DIR,
+    )
+    args.url = f"http://127.0.0.1:{port}"
+    # The index is built before the app starts
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit("uvicorn exited before the app started")
+        try:
+            if httpx.get(f"{args.url}/health").status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    sys.exit("Timed out waiting for the app to start")
+
+
+def configure_local_instance(args: argparse.Namespace, path: str) -> None:
+    """Generate the corpus and configure the app to use it."""
+    if not os.path.isdir(os.path.join(ROOT_DIR, "client", "dist")):
+        sys.exit("The client must be built first (npm run build)")
+    corpus_bytes = write_corpus(path, corpus_options_from_args(args))
+    print(
+        f"Generated {args.notes} notes ({corpus_bytes / 1024 / 1024:.1f} MB)"
+    )
+    os.environ.update(
+        {
+            "FLATNOTES_PATH": path,
+            "FLATNOTES_AUTH_TYPE": "password",
+            "FLATNOTES_USERNAME": args.username,
+            "FLATNOTES_PASSWORD": args.password,
+            "FLATNOTES_SECRET_KEY": "load-test-secret-key",
+            "FLATNOTES_METRICS_ENABLED": "true",
+        }
+    )
+    os.environ.setdefault("LOGLEVEL", "WARNING")
+
+
+def print_summary(summary: dict) -> None:
+    print(
+        f"{summary['requests']} requests, "
+        + f"{summary['requests_per_s']} req/s, "
+        + f"error rate {summary['error_rate']:.2%} "
+        + f"({summary['unauthorized']} unauthorized, "
+        + f"{summary['server_errors']} server errors), "
+        + f"index lock retries: {summary['index_lock_retries']}"
+    )
+    print(f"Latency: {summary['latency']}")
+    for name, operation in summary["operations"].items():
+        print(
+            f"  {name}: {operation['requests']} requests, "
+            + f"{operation['latency']}, statuses {operation['statuses']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument(
+        "--uvicorn",
+        action="store_true",
+        help="Run the app in a separate uvicorn process.",
+    )
+    target.add_argument("--url", help="Test an already running instance.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="uvicorn worker processes (with --uvicorn).",
+    )
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--username", default="user")
+    parser.add_argument("--password", default="password")
+    parser.add_argument(
+        "--token", help="A session token to use instead of logging in."
+    )
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default="search=40,get=30,patch=10,attachment=10,tags=10",
+        help="Relative weights of the operations: "
+        + ", ".join(OPERATIONS)
+        + ".",
+    )
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--search-limit", type=int, default=20)
+    parser.add_argument("--scratch-notes", type=int, default=20)
+    parser.add_argument("--attachments", type=int, default=5)
+    parser.add_argument("--attachment-kb", type=int, default=256)
+    add_corpus_arguments(parser)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    temp_dir = None
+    process = None
+    transport = None
+    try:
+        if args.url is None:
+            temp_dir = tempfile.mkdtemp(prefix="flatnotes-load-test-")
+            configure_local_instance(args, os.path.join(temp_dir, "notes"))
+            if args.uvicorn:
+                process = start_uvicorn(args)
+            else:
+                # The app serves the client relative to the working directory
+                os.chdir(ROOT_DIR)
+                from main import app
+
+                transport = httpx.ASGITransport(app=app)
+                args.url = "http://flatnotes"
+        summary = asyncio.run(run(args, transport, temp_dir is not None))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    print_summary(summary)
+    save_results(args, summary, env=RECORDED_ENV)
+    # Stop the index threads of an in-process app without waiting for them
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Helpers shared by the benchmarks to summarise, save and compare results."""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+
+def percentiles(durations: List[float]) -> Dict[str, float]:
+    """Return the p50, p90, p99 and max of the given durations (in seconds)
+    in milliseconds."""
+    ordered = sorted(durations)
+    if not ordered:
+        return {}
+
+    def percentile(p: float) -> float:
+        index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def add_output_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--output", help="Write the results as JSON.")
+    parser.add_argument("--compare", help="Previous results to compare to.")
+
+
+def save_results(
+    args: argparse.Namespace, results: dict, env: Iterable[str] = ()
+) -> None:
+    """Write the results, along with details of the run, to the file given
+    in --output and compare them with those in the file given in
+    --compare."""
+    if args.output:
+        output = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "args": vars(args),
+                "env": {key: os.environ.get(key) for key in env},
+            },
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+        print(f"Results written to '{args.output}'")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f)["results"], results)
+
+
+def compare(old: dict, new: dict, prefix: str = "") -> None:
+    """Print the relative change of every numeric result."""
+    for key, value in new.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            compare(old.get(key, {}), value, prefix=f"{name}.")
+        elif isinstance(value, (int, float)) and isinstance(
+            old.get(key), (int, float)
+        ):
+            change = (value - old[key]) / old[key] * 100 if old[key] else 0.0
+            print(f"{name}: {old[key]} -> {value} ({change:+.1f}%)")
@@ -0,0 +1,220 @@
+"""Benchmark a notes storage backend against a synthetic corpus.
+
+Measures a cold index build, a no-op sync of an up to date index, search
+latency per sort order, getting the tags and create/update/delete
+throughput. Results are printed and, optionally, written as JSON so that runs
+can be compared (see --compare). To compare the search backends, see
+backends.py.
+
+Usage: python benchmarks/suite.py [--notes 1000] [--output results.json]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+# Indexing logs every note at INFO level
+os.environ.setdefault("LOGLEVEL", "WARNING")
+# Every search should hit the index
+os.environ["FLATNOTES_SEARCH_CACHE_RESULTS"] = "0"
+
+from corpus import (  # noqa: E402
+    ACCENTED_WORDS,
+    add_corpus_arguments,
+    corpus_options_from_args,
+    write_corpus,
+)
+from results import (  # noqa: E402
+    add_output_arguments,
+    percentiles,
+    save_results,
+)
+
+SORTS = ("score", "title", "last_modified")
+SEARCH_TERMS = (
+    "project",
+    "meeting notes",
+    "connecting",  # Stemmed
+    "cafe",  # Accent folded
+    ACCENTED_WORDS[1],
+    "#tag1",
+    "#tag1 review",
+    "title:note",
+    "*",
+)
+# Settings that affect the results and are recorded with them
+RECORDED_ENV = (
+    "FLATNOTES_INDEX_WORKERS",
+    "FLATNOTES_WATCH_MODE",
+    "FLATNOTES_INDEX_COMMIT_DELAY_MS",
+    "FLATNOTES_SEARCH_THREADS",
+)
+
+
+def time_calls(function: Callable[[], object], repeat: int) -> List[float]:
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def run(args: argparse.Namespace, path: str) -> dict:
+    options = corpus_options_from_args(args)
+    results = {}
+
+    start_time = time.perf_counter()
+    corpus_bytes = write_corpus(path, options)
+    results["corpus"] = {
+        "notes": options.notes,
+        "bytes": corpus_bytes,
+        "generate_s": round(time.perf_counter() - start_time, 3),
+    }
+    print(
+        f"Generated {options.notes} notes "
+        + f"({corpus_bytes / 1024 / 1024:.1f} MB)"
+    )
+
+    os.environ["FLATNOTES_PATH"] = path
+    from notes.models import NoteCreate, NoteUpdate
+
+    if args.backend == "sqlite":
+        from notes.sqlite import SQLiteNotes as Notes
+    else:
+        from notes.file_system import FileSystemNotes as Notes
+
+    # Note: Only one instance is created per process as the indexer lock is
+    # held until the process exits
+    start_time = time.perf_counter()
+    notes = Notes()
+    results["cold_build"] = {
+        "s": round(time.perf_counter() - start_time, 3),
+        "index_bytes": notes._index_size(),
+    }
+    print(f"Cold build: {results['cold_build']['s']} s")
+
+    durations = time_calls(notes._sync_index, args.sync_repeat)
+    results["warm_sync"] = percentiles(durations)
+    print(f"Warm sync (no-op): {results['warm_sync']}")
+
+    results["search"] = {}
+    for sort in SORTS:
+        durations = []
+        for term in SEARCH_TERMS:
+            durations.extend(
+                time_calls(
+                    lambda: notes.search(
+                        term,
+                        sort=sort,
+                        limit=args.limit,
+                        highlights=args.highlights,
+                    ),
+                    args.search_repeat,
+                )
+            )
+        results["search"][sort] = percentiles(durations)
+        print(f"Search (sort={sort}): {results['search'][sort]}")
+    results["search_terms"] = {
+        term: percentiles(
+            time_calls(
+                lambda: notes.search(
+                    term, limit=args.limit, highlights=args.highlights
+                ),
+                args.search_repeat,
+            )
+        )
+        for term in SEARCH_TERMS
+    }
+
+    durations = time_calls(notes.get_tags, args.search_repeat)
+    results["get_tags"] = percentiles(durations)
+    print(f"Get tags: {results['get_tags']}")
+
+    # Throughput includes committing the changes to the index
+    titles = [f"Benchmark {index:06d}" for index in range(args.writes)]
+    results["writes"] = {}
+    for operation, function in (
+        (
+            "create",
+            lambda title: notes.create(
+                NoteCreate(title=title, content="café #benchmark project")
+            ),
+        ),
+        (
+            "update",
+            lambda title: notes.update(
+                title,
+                NoteUpdate(new_content="resume #benchmark meeting updated"),
+            ),
+        ),
+        ("delete", notes.delete),
+    ):
+        start_time = time.perf_counter()
+        for title in titles:
+            function(title)
+        notes._index_writer.flush()
+        duration = time.perf_counter() - start_time
+        results["writes"][operation] = {
+            "ops": args.writes,
+            "ops_per_s": round(args.writes / duration, 1),
+        }
+        print(f"{operation.title()}: {results['writes'][operation]}")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_corpus_arguments(parser)
+    parser.add_argument(
+        "--backend", choices=("whoosh", "sqlite"), default="whoosh"
+    )
+    parser.add_argument(
+        "--path",
+        help="Directory in which to generate the corpus. Must not exist. "
+        + "Defaults to a temporary directory that is removed afterwards.",
+    )
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument(
+        "--no-highlights",
+        dest="highlights",
+        action="store_false",
+        help="Search without highlights (which dominate the search time for "
+        + "large notes).",
+    )
+    parser.add_argument("--search-repeat", type=int, default=20)
+    parser.add_argument("--sync-repeat", type=int, default=10)
+    parser.add_argument("--writes", type=int, default=200)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    if args.path is not None:
+        if os.path.exists(args.path):
+            parser.error(f"'{args.path}' already exists")
+        path = args.path
+        temp_dir = None
+    else:
+        temp_dir = tempfile.mkdtemp(prefix="flatnotes-benchmark-")
+        path = os.path.join(temp_dir, "notes")
+
+    try:
+        results = run(args, path)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    save_results(args, results, env=RECORDED_ENV)
+    # Stop the index threads without waiting for them
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Compare the per request cost of validating a session token with and
+without the verified token cache in LocalAuth.
+
+Usage: python benchmarks/token_cache.py [--requests 20000] [--repeat 5]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+os.environ.setdefault("FLATNOTES_AUTH_TYPE", "password")
+os.environ.setdefault("FLATNOTES_USERNAME", "user")
+os.environ.setdefault("FLATNOTES_PASSWORD", "password")
+os.environ.setdefault("FLATNOTES_SECRET_KEY", "benchmark-secret-key")
+
+from auth.local import LocalAuth  # noqa: E402
+from auth.models import Login  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    auth = LocalAuth()
+    token = auth.login(
+        Login(
+            username=os.environ["FLATNOTES_USERNAME"],
+            password=os.environ["FLATNOTES_PASSWORD"],
+        )
+    ).access_token
+
+    def uncached():
+        auth._token_cache.clear()
+        auth._validate_token(token)
+
+    def cached():
+        auth._validate_token(token)
+
+    print(f"{args.requests} requests, best of {args.repeat}")
+    results = {}
+    for name, func in [("uncached", uncached), ("cached", cached)]:
+        func()
+        best = min(
+            timeit.repeat(func, number=args.requests, repeat=args.repeat)
+        )
+        results[name] = best
+        print(f"{name:>10}: {best / args.requests * 1e6:8.2f} µs/request")
+    print(f"{'speedup':>10}: {results['uncached'] / results['cached']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -142,11 +142,12 @@ export async function getTags() {
 
 export async function createAttachment(file) {
   try {
-    const formData = new FormData();
-    formData.append("file", file);
-    const response = await api.post("api/attachments", formData, {
+    // Send the raw file rather than a multipart form so that the server can
+    // stream it straight to disk.
+    const response = await api.post("api/attachments", file, {
+      params: { filename: file.name },
       headers: {
-        "Content-Type": "multipart/form-data",
+        "Content-Type": "application/octet-stream",
       },
     });
     return response.data;
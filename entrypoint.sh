@@ -3,6 +3,7 @@
 [ "$EXEC_TOOL" ] || EXEC_TOOL=gosu
 [ "$FLATNOTES_HOST" ] || FLATNOTES_HOST=0.0.0.0
 [ "$FLATNOTES_PORT" ] || FLATNOTES_PORT=8080
+[ "$FLATNOTES_WORKERS" ] || FLATNOTES_WORKERS=1
 
 set -e
 
@@ -27,6 +28,7 @@ flatnotes_command="python -m \
                   --app-dir server \
                   --host ${FLATNOTES_HOST} \
                   --port ${FLATNOTES_PORT} \
+                  --workers ${FLATNOTES_WORKERS} \
                   --proxy-headers \
                   --forwarded-allow-ips '*'"
 
@@ -2,6 +2,10 @@ login_failed = "Invalid login details."
 note_exists = "Cannot create note. A note with the same title already exists."
 note_not_found = "The specified note cannot be found."
 invalid_note_title = "The specified note title contains invalid characters."
+note_modified = (
+    "The note has been modified since it was loaded. Please reload it and "
+    "try again."
+)
 attachment_exists = (
     "Cannot create attachment. An attachment with the same filename already "
     "exists."
@@ -10,3 +14,15 @@ attachment_not_found = "The specified attachment cannot be found."
 invalid_attachment_filename = (
     "The specified filename contains invalid characters."
 )
+attachment_too_large = "The attachment exceeds the maximum allowed size."
+attachment_missing = (
+    "No attachment was provided. Please provide a file or a filename."
+)
+length_required = (
+    "The size of the upload must be given in the Content-Length header."
+)
+upload_not_found = "The specified upload cannot be found."
+upload_offset_mismatch = (
+    "The upload offset does not match the amount of data received. Please "
+    "check the upload's progress and try again."
+)
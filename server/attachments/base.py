@@ -1,9 +1,11 @@
 from abc import ABC, abstractmethod
+from typing import AsyncIterator, Optional
 
 from fastapi import UploadFile
 from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
 
-from .models import AttachmentCreateResponse
+from .models import AttachmentCreateResponse, AttachmentUpload
 
 
 class BaseAttachments(ABC):
@@ -13,6 +15,58 @@ class BaseAttachments(ABC):
         pass
 
     @abstractmethod
-    def get(self, filename: str) -> FileResponse:
-        """Get a specific attachment."""
+    def get(self, filename: str, width: Optional[int] = None) -> FileResponse:
+        """Get a specific attachment. If a width is given and the attachment
+        is an image wider than that, a resized copy is returned instead."""
         pass
+
+    @abstractmethod
+    async def create_from_stream_async(
+        self, filename: str, chunks: AsyncIterator[bytes]
+    ) -> AttachmentCreateResponse:
+        """Create a new attachment from a stream of chunks."""
+        pass
+
+    @abstractmethod
+    def create_upload(self, filename: str, size: int) -> AttachmentUpload:
+        """Start a resumable upload of an attachment of the given size."""
+        pass
+
+    @abstractmethod
+    def get_upload(self, upload_id: str) -> AttachmentUpload:
+        """Get the progress of a resumable upload."""
+        pass
+
+    @abstractmethod
+    async def write_upload_async(
+        self, upload_id: str, offset: int, chunks: AsyncIterator[bytes]
+    ) -> AttachmentUpload:
+        """Write a stream of chunks to a resumable upload starting at the
+        given offset. Once the upload is complete, the attachment is created
+        and included in the returned upload."""
+        pass
+
+    # Async Variants
+    # Note: These default to running the synchronous methods in Starlette's
+    # threadpool. Implementations should override them where they can avoid
+    # blocking I/O.
+    async def create_async(self, file: UploadFile) -> AttachmentCreateResponse:
+        """Create a new attachment."""
+        return await run_in_threadpool(self.create, file)
+
+    async def get_async(
+        self, filename: str, width: Optional[int] = None
+    ) -> FileResponse:
+        """Get a specific attachment. If a width is given and the attachment
+        is an image wider than that, a resized copy is returned instead."""
+        return await run_in_threadpool(self.get, filename, width)
+
+    async def create_upload_async(
+        self, filename: str, size: int
+    ) -> AttachmentUpload:
+        """Start a resumable upload of an attachment of the given size."""
+        return await run_in_threadpool(self.create_upload, filename, size)
+
+    async def get_upload_async(self, upload_id: str) -> AttachmentUpload:
+        """Get the progress of a resumable upload."""
+        return await run_in_threadpool(self.get_upload, upload_id)
@@ -1,18 +1,41 @@
+import hashlib
+import json
 import os
+import re
 import shutil
+import stat
+import sys
+import time
 import urllib.parse
+import uuid
 from datetime import datetime
+from typing import AsyncIterator, Optional, Tuple
 
+import aiofiles
+import aiofiles.os
 from fastapi import UploadFile
 from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
 
 from helpers import get_env, is_valid_filename
+from logger import logger
 
 from ..base import BaseAttachments
-from ..models import AttachmentCreateResponse
+from ..models import AttachmentCreateResponse, AttachmentUpload
+from .variant_cache import VariantCache
 
 
 class FileSystemAttachments(BaseAttachments):
+    CHUNK_SIZE = 1024 * 1024
+    BLOBS_DIRNAME = ".blobs"
+    UPLOADS_DIRNAME = ".uploads"
+    TEMP_PREFIX = "tmp-"
+    # Incomplete uploads are removed at startup once they haven't been
+    # written to for this long
+    UPLOAD_EXPIRY_HOURS = 24
+    UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+    BLOB_MODE = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
     def __init__(self):
         self.base_path = get_env("FLATNOTES_PATH", mandatory=True)
         if not os.path.exists(self.base_path):
@@ -21,31 +44,319 @@ class FileSystemAttachments(BaseAttachments):
             )
         self.storage_path = os.path.join(self.base_path, "attachments")
         os.makedirs(self.storage_path, exist_ok=True)
+        # Uploads are written to temporary files alongside the attachments
+        # so that they can be moved into place atomically once complete
+        self.uploads_path = os.path.join(
+            self.storage_path, self.UPLOADS_DIRNAME
+        )
+        os.makedirs(self.uploads_path, exist_ok=True)
+        self._remove_expired_uploads()
+        # In dedupe mode, the content of each attachment is stored once in
+        # the blobs directory, named by its SHA-256 hash, and attachments
+        # are hard links to their blob. Note: Editing an attachment in place
+        # would change every attachment with the same content, so blobs
+        # (and so the attachments linked to them) are read-only. To edit a
+        # deduplicated attachment outside flatnotes, replace the file
+        # instead.
+        self.dedupe = get_env(
+            "FLATNOTES_ATTACHMENT_DEDUPE",
+            mandatory=False,
+            default=False,
+            cast_bool=True,
+        )
+        self.blobs_path = os.path.join(self.storage_path, self.BLOBS_DIRNAME)
+        if self.dedupe:
+            os.makedirs(self.blobs_path, exist_ok=True)
+            self._remove_unused_blobs()
+        self.variant_cache = self._load_variant_cache()
 
     def create(self, file: UploadFile) -> AttachmentCreateResponse:
         """Create a new attachment."""
         is_valid_filename(file.filename)
+        temp_path = self._temp_path()
         try:
-            self._save_file(file)
-        except FileExistsError:
-            file.filename = self._datetime_suffix_filename(file.filename)
-            self._save_file(file)
-        return AttachmentCreateResponse(
-            filename=file.filename, url=self._url_for_filename(file.filename)
-        )
+            digest = self._new_digest()
+            with open(temp_path, "xb") as f:
+                while chunk := file.file.read(self.CHUNK_SIZE):
+                    if digest is not None:
+                        digest.update(chunk)
+                    f.write(chunk)
+            filename = self._publish(temp_path, file.filename, digest)
+        finally:
+            self._remove_if_exists(temp_path)
+        return self._create_response(filename)
 
-    def get(self, filename: str) -> FileResponse:
-        """Get a specific attachment."""
+    def get(self, filename: str, width: Optional[int] = None) -> FileResponse:
+        """Get a specific attachment. If a width is given and the attachment
+        is an image wider than that, a resized copy is returned instead."""
         is_valid_filename(filename)
         filepath = os.path.join(self.storage_path, filename)
         if not os.path.isfile(filepath):
             raise FileNotFoundError(f"'{filename}' not found.")
+        if width is not None and self.variant_cache is not None:
+            variant_path = self.variant_cache.get(filepath, width)
+            if variant_path is not None:
+                return FileResponse(variant_path)
+        return FileResponse(filepath)
+
+    async def create_async(self, file: UploadFile) -> AttachmentCreateResponse:
+        """Create a new attachment."""
+        return await self.create_from_stream_async(
+            file.filename, self._iter_upload_file(file)
+        )
+
+    async def get_async(
+        self, filename: str, width: Optional[int] = None
+    ) -> FileResponse:
+        """Get a specific attachment. If a width is given and the attachment
+        is an image wider than that, a resized copy is returned instead."""
+        if width is not None and self.variant_cache is not None:
+            # Resizing is CPU bound so is run in the threadpool
+            return await run_in_threadpool(self.get, filename, width)
+        is_valid_filename(filename)
+        filepath = os.path.join(self.storage_path, filename)
+        if not await aiofiles.os.path.isfile(filepath):
+            raise FileNotFoundError(f"'{filename}' not found.")
         return FileResponse(filepath)
 
-    def _save_file(self, file: UploadFile):
-        filepath = os.path.join(self.storage_path, file.filename)
-        with open(filepath, "xb") as f:
-            shutil.copyfileobj(file.file, f)
+    async def create_from_stream_async(
+        self, filename: str, chunks: AsyncIterator[bytes]
+    ) -> AttachmentCreateResponse:
+        """Create a new attachment from a stream of chunks. The chunks are
+        written to a temporary file which is only moved into place once the
+        stream is complete."""
+        is_valid_filename(filename)
+        temp_path = self._temp_path()
+        try:
+            digest = self._new_digest()
+            async with aiofiles.open(temp_path, "xb") as f:
+                async for chunk in chunks:
+                    if digest is not None:
+                        digest.update(chunk)
+                    await f.write(chunk)
+            filename = await run_in_threadpool(
+                self._publish, temp_path, filename, digest
+            )
+        finally:
+            await run_in_threadpool(self._remove_if_exists, temp_path)
+        return self._create_response(filename)
+
+    def create_upload(self, filename: str, size: int) -> AttachmentUpload:
+        """Start a resumable upload of an attachment of the given size."""
+        is_valid_filename(filename)
+        upload_id = uuid.uuid4().hex
+        data_path, metadata_path = self._upload_paths(upload_id)
+        open(data_path, "xb").close()
+        with open(metadata_path, "x") as f:
+            json.dump({"filename": filename, "size": size}, f)
+        upload = AttachmentUpload(
+            id=upload_id, filename=filename, size=size, offset=0
+        )
+        if size == 0:
+            return self._complete_upload(upload)
+        return upload
+
+    def get_upload(self, upload_id: str) -> AttachmentUpload:
+        """Get the progress of a resumable upload."""
+        data_path, metadata_path = self._upload_paths(upload_id)
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+        return AttachmentUpload(
+            id=upload_id,
+            filename=metadata["filename"],
+            size=metadata["size"],
+            offset=os.path.getsize(data_path),
+        )
+
+    async def write_upload_async(
+        self, upload_id: str, offset: int, chunks: AsyncIterator[bytes]
+    ) -> AttachmentUpload:
+        """Write a stream of chunks to a resumable upload starting at the
+        given offset. Once the upload is complete, the attachment is created
+        and included in the returned upload."""
+        data_path, _ = self._upload_paths(upload_id)
+        # Note: Writing at the given offset, rather than appending, means a
+        # chunk that is retried after a partial write is written correctly.
+        async with aiofiles.open(data_path, "r+b") as f:
+            await f.seek(offset)
+            async for chunk in chunks:
+                await f.write(chunk)
+        upload = await self.get_upload_async(upload_id)
+        if upload.offset >= upload.size:
+            return await run_in_threadpool(self._complete_upload, upload)
+        return upload
+
+    def _load_variant_cache(self) -> Optional[VariantCache]:
+        key = "FLATNOTES_ATTACHMENT_VARIANT_CACHE_MB"
+        max_size = get_env(key, mandatory=False, default=256, cast_int=True)
+        if max_size < 0:
+            logger.error(
+                f"Invalid value '{max_size}' for {key}. "
+                + "Must be 0 or greater."
+            )
+            sys.exit(1)
+        if max_size == 0:
+            return None
+        return VariantCache(
+            os.path.join(self.base_path, ".flatnotes", "attachment-variants"),
+            max_size * 1024 * 1024,
+        )
+
+    async def _iter_upload_file(
+        self, file: UploadFile
+    ) -> AsyncIterator[bytes]:
+        while chunk := await file.read(self.CHUNK_SIZE):
+            yield chunk
+
+    def _temp_path(self) -> str:
+        return os.path.join(
+            self.uploads_path, self.TEMP_PREFIX + uuid.uuid4().hex
+        )
+
+    def _upload_paths(self, upload_id: str) -> Tuple[str, str]:
+        """Return the paths of the data and metadata files for the given
+        resumable upload."""
+        if not self.UPLOAD_ID_RE.match(upload_id):
+            raise FileNotFoundError(f"Upload '{upload_id}' not found.")
+        data_path = os.path.join(self.uploads_path, upload_id)
+        return data_path, data_path + ".json"
+
+    def _complete_upload(self, upload: AttachmentUpload) -> AttachmentUpload:
+        """Create the attachment for a completed resumable upload."""
+        data_path, metadata_path = self._upload_paths(upload.id)
+        try:
+            filename = self._publish(data_path, upload.filename)
+        finally:
+            self._remove_if_exists(data_path)
+            self._remove_if_exists(metadata_path)
+        upload.attachment = self._create_response(filename)
+        return upload
+
+    def _new_digest(self) -> Optional["hashlib._Hash"]:
+        """Return a new hash object for hashing an upload as it is written,
+        or None if attachments aren't deduplicated."""
+        return hashlib.sha256() if self.dedupe else None
+
+    def _publish(
+        self,
+        temp_path: str,
+        filename: str,
+        digest: Optional["hashlib._Hash"] = None,
+    ) -> str:
+        """Move a complete upload into place as an attachment with the given
+        filename and return the filename used. If the upload wasn't hashed
+        as it was written (e.g. a resumable upload) and attachments are
+        deduplicated, it is hashed now."""
+        if not self.dedupe:
+            return self._link_attachment(temp_path, filename)
+        if digest is None:
+            digest = hashlib.sha256()
+            with open(temp_path, "rb") as f:
+                while chunk := f.read(self.CHUNK_SIZE):
+                    digest.update(chunk)
+        return self._link_attachment(
+            self._store_blob(temp_path, digest.hexdigest()), filename
+        )
+
+    def _store_blob(self, temp_path: str, digest: str) -> str:
+        """Move the temporary file into place as the blob for the given
+        digest, or discard it if that blob already exists. Returns the path
+        to the blob."""
+        blob_path = os.path.join(self.blobs_path, digest)
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+        else:
+            os.chmod(temp_path, self.BLOB_MODE)
+            os.replace(temp_path, blob_path)
+        return blob_path
+
+    def _link_attachment(self, source_path: str, filename: str) -> str:
+        """Create an attachment with the given filename from the given file
+        and return the filename used. If an attachment with the same
+        filename is already linked to the same file, it is reused. If the
+        filename is used by a different attachment, a timestamp suffix is
+        added."""
+        filepath = os.path.join(self.storage_path, filename)
+        try:
+            self._link(source_path, filepath)
+            return filename
+        except FileExistsError:
+            if os.path.samefile(source_path, filepath):
+                return filename
+        filename = self._datetime_suffix_filename(filename)
+        self._link(source_path, os.path.join(self.storage_path, filename))
+        return filename
+
+    def _link(self, source_path: str, filepath: str) -> None:
+        """Atomically create the given filepath as a hard link to the source
+        file. If the file system doesn't support hard links, a copy is moved
+        into place instead."""
+        try:
+            os.link(source_path, filepath)
+            return
+        except FileExistsError:
+            raise
+        except OSError as e:
+            logger.warning(
+                f"Failed to link '{filepath}' ({e}). Copying instead."
+            )
+        if os.path.exists(filepath):
+            raise FileExistsError(f"'{filepath}' already exists.")
+        temp_path = self._temp_path()
+        try:
+            shutil.copyfile(source_path, temp_path)
+            os.rename(temp_path, filepath)
+        finally:
+            self._remove_if_exists(temp_path)
+
+    def _remove_expired_uploads(self) -> None:
+        """Remove incomplete uploads, along with any temporary files left
+        behind by interrupted uploads, that haven't been written to for
+        UPLOAD_EXPIRY_HOURS."""
+        expiry_time = time.time() - self.UPLOAD_EXPIRY_HOURS * 60 * 60
+        removed = 0
+        with os.scandir(self.uploads_path) as entries:
+            for entry in entries:
+                if (
+                    not entry.is_file()
+                    or entry.name.endswith(".json")
+                    or entry.stat().st_mtime >= expiry_time
+                ):
+                    continue
+                os.remove(entry.path)
+                self._remove_if_exists(entry.path + ".json")
+                removed += 1
+        if removed:
+            logger.info(f"Removed {removed} expired attachment uploads")
+
+    def _remove_unused_blobs(self) -> None:
+        """Remove blobs that are no longer linked to by any attachment and
+        make sure the rest are read-only."""
+        removed = 0
+        with os.scandir(self.blobs_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                blob_stat = entry.stat()
+                if blob_stat.st_nlink == 1:
+                    os.remove(entry.path)
+                    removed += 1
+                elif stat.S_IMODE(blob_stat.st_mode) != self.BLOB_MODE:
+                    os.chmod(entry.path, self.BLOB_MODE)
+        if removed:
+            logger.info(f"Removed {removed} unused attachment blobs")
+
+    @staticmethod
+    def _remove_if_exists(filepath: str) -> None:
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+
+    def _create_response(self, filename: str) -> AttachmentCreateResponse:
+        return AttachmentCreateResponse(
+            filename=filename, url=self._url_for_filename(filename)
+        )
 
     def _datetime_suffix_filename(self, filename: str) -> str:
         """Add a timestamp suffix to the filename."""
@@ -0,0 +1,178 @@
+import hashlib
+import math
+import mimetypes
+import os
+import threading
+import uuid
+from typing import Optional
+
+from logger import logger
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional
+    Image = None
+
+
+class VariantCache:
+    """Generate resized copies (variants) of image attachments and cache them
+    on disk. The cache is limited to `max_size` bytes with the least recently
+    used variants being evicted first.
+
+    Variants are keyed by the attachment's path, modification time and size
+    so a changed attachment never serves a stale variant. Requested widths
+    are rounded up to one of WIDTHS so that only a handful of variants can be
+    created for each image. Wider requests are served the original.
+
+    If Pillow isn't installed, no variants are generated."""
+
+    WIDTHS = (320, 640, 800, 1280, 1920)
+    SAVE_OPTIONS = {
+        "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+        "PNG": {"optimize": True},
+        "WEBP": {"quality": 85},
+    }
+    MEDIA_TYPES = ("image/jpeg", "image/png", "image/webp")
+    TEMP_PREFIX = "tmp-"
+    EXIF_ORIENTATION = 0x0112
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self._size = self._scan()
+        self._evict()
+        if Image is None:
+            logger.info(
+                "Pillow is not installed. Resized attachments are disabled."
+            )
+
+    @classmethod
+    def width_for(cls, width: int) -> Optional[int]:
+        """Round the requested width up to the nearest supported width.
+        Returns None if the requested width is wider than all of them."""
+        for supported_width in cls.WIDTHS:
+            if width <= supported_width:
+                return supported_width
+        return None
+
+    def get(self, source_path: str, width: int) -> Optional[str]:
+        """Return the path to a variant of the given image resized to the
+        given width, generating it if it isn't cached. Returns None if the
+        original should be used instead e.g. the file isn't a supported
+        image or isn't wider than the requested width."""
+        if (
+            Image is None
+            or mimetypes.guess_type(source_path)[0] not in self.MEDIA_TYPES
+        ):
+            return None
+        width = self.width_for(width)
+        if width is None:
+            return None
+        stat = os.stat(source_path)
+        key = hashlib.sha256(
+            f"{os.path.abspath(source_path)}\0{stat.st_mtime_ns}\0"
+            f"{stat.st_size}\0{width}".encode()
+        ).hexdigest()[:32]
+        variant_path = os.path.join(
+            self.path, key + os.path.splitext(source_path)[1].lower()
+        )
+        try:
+            # Record the use of the variant for LRU eviction
+            os.utime(variant_path)
+            return variant_path
+        except FileNotFoundError:
+            pass
+        try:
+            size = self._generate(source_path, variant_path, width)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logger.warning(f"Failed to resize '{source_path}': {e}")
+            return None
+        if size is None:
+            return None
+        with self._lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict(keep=variant_path)
+        return variant_path
+
+    def _generate(
+        self, source_path: str, variant_path: str, width: int
+    ) -> Optional[int]:
+        """Save a variant of the source image resized to the given width and
+        return its size in bytes, or None if no variant is needed."""
+        with Image.open(source_path) as image:
+            image_format = image.format
+            if image_format not in self.SAVE_OPTIONS or getattr(
+                image, "is_animated", False
+            ):
+                return None
+            # The displayed width depends on the EXIF orientation
+            orientation = image.getexif().get(self.EXIF_ORIENTATION, 1)
+            rotated = orientation in (5, 6, 7, 8)
+            displayed_width = image.height if rotated else image.width
+            if displayed_width <= width:
+                return None
+            # Let JPEG decoding downscale (by a power of 2) before resizing
+            scale = width / displayed_width
+            image.draft(
+                image.mode,
+                (
+                    math.ceil(image.width * scale),
+                    math.ceil(image.height * scale),
+                ),
+            )
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width, image.height), Image.LANCZOS)
+            # Note: The cache directory is recreated in case it was removed
+            # along with an outdated search index
+            os.makedirs(self.path, exist_ok=True)
+            temp_path = os.path.join(
+                self.path, self.TEMP_PREFIX + uuid.uuid4().hex
+            )
+            try:
+                image.save(
+                    temp_path, image_format, **self.SAVE_OPTIONS[image_format]
+                )
+                os.replace(temp_path, variant_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return os.path.getsize(variant_path)
+
+    def _scan(self) -> int:
+        total = 0
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    total += entry.stat().st_size
+        return total
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """Remove the least recently used variants, other than `keep`, until
+        the cache is within its maximum size. Note: Another process may share
+        the cache so the directory is rescanned rather than relying on the
+        tracked size."""
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file() and entry.path != keep:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            total += os.path.getsize(keep)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._size = total
+        if removed:
+            logger.debug(f"Evicted {removed} cached attachment variants")
@@ -1,6 +1,23 @@
+from typing import Optional
+
+from pydantic import Field
+
 from helpers import CustomBaseModel
 
 
 class AttachmentCreateResponse(CustomBaseModel):
     filename: str
     url: str
+
+
+class AttachmentUploadCreate(CustomBaseModel):
+    filename: str
+    size: int = Field(ge=0)
+
+
+class AttachmentUpload(CustomBaseModel):
+    id: str
+    filename: str
+    size: int
+    offset: int
+    attachment: Optional[AttachmentCreateResponse] = None
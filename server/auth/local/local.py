@@ -1,5 +1,9 @@
+import hashlib
 import secrets
+import threading
+import time
 from base64 import b32encode
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from fastapi import Depends, HTTPException, Request
@@ -21,6 +25,9 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token", auto_error=False)
 
 class LocalAuth(BaseAuth):
     JWT_ALGORITHM = "HS256"
+    # The number of verified tokens to remember so that repeated requests
+    # with the same token don't need to verify it again
+    TOKEN_CACHE_SIZE = 256
 
     def __init__(self) -> None:
         self.username = get_env("FLATNOTES_USERNAME", mandatory=True).lower()
@@ -40,6 +47,10 @@ class LocalAuth(BaseAuth):
             self.last_used_totp = None
             self._display_totp_enrolment()
 
+        # Verified tokens keyed by their SHA-256 hash, with their expiry
+        self._token_cache: OrderedDict[bytes, float] = OrderedDict()
+        self._token_cache_lock = threading.Lock()
+
     def login(self, data: Login) -> Token:
         # Check Username
         username_correct = secrets.compare_digest(
@@ -92,12 +103,39 @@ class LocalAuth(BaseAuth):
     def _validate_token(self, token: str) -> bool:
         if token is None:
             raise ValueError
+        key = hashlib.sha256(token.encode("utf-8")).digest()
+        if self._is_cached_token(key):
+            return
         payload = jwt.decode(
             token, self.secret_key, algorithms=[self.JWT_ALGORITHM]
         )
         username = payload.get("sub")
         if username is None or username.lower() != self.username:
             raise ValueError
+        self._cache_token(key, payload.get("exp"))
+
+    def _is_cached_token(self, key: bytes) -> bool:
+        """Return True if the token with the given hash has already been
+        verified and hasn't expired since."""
+        with self._token_cache_lock:
+            expiry = self._token_cache.get(key)
+            if expiry is None:
+                return False
+            if expiry <= time.time():
+                del self._token_cache[key]
+                return False
+            self._token_cache.move_to_end(key)
+            return True
+
+    def _cache_token(self, key: bytes, expiry) -> None:
+        # Tokens without an expiry are always verified
+        if not isinstance(expiry, (int, float)):
+            return
+        with self._token_cache_lock:
+            self._token_cache[key] = expiry
+            self._token_cache.move_to_end(key)
+            while len(self._token_cache) > self.TOKEN_CACHE_SIZE:
+                self._token_cache.popitem(last=False)
 
     def _create_access_token(self, data: dict):
         to_encode = data.copy()
@@ -1,5 +1,7 @@
+import os
 import sys
 from enum import Enum
+from typing import Optional
 
 from helpers import CustomBaseModel, get_env
 from logger import logger
@@ -15,6 +17,17 @@ class GlobalConfig:
         self.quick_access_sort: str = self._quick_access_sort()
         self.quick_access_limit: int = self._quick_access_limit()
         self.path_prefix: str = self._load_path_prefix()
+        self.search_backend: str = self._load_search_backend()
+        self.attachment_max_size: Optional[int] = (
+            self._load_attachment_max_size()
+        )
+        self.metrics_enabled: bool = self._load_metrics_enabled()
+        self.metrics_auth: bool = self._load_metrics_auth()
+        self.profiling_mode: str = self._load_profiling_mode()
+        if self.profiling_mode != "off":
+            self.profiling_threshold: float = self._load_profiling_threshold()
+            self.profiling_keep: int = self._load_profiling_keep()
+            self.profiling_path: str = self._load_profiling_path()
 
     def load_auth(self):
         if self.auth_type in (AuthType.NONE, AuthType.READ_ONLY):
@@ -25,9 +38,14 @@ class GlobalConfig:
             return LocalAuth()
 
     def load_note_storage(self):
-        from notes.file_system import FileSystemNotes
+        if self.search_backend == "sqlite":
+            from notes.sqlite import SQLiteNotes
+
+            return SQLiteNotes()
+        else:
+            from notes.file_system import FileSystemNotes
 
-        return FileSystemNotes()
+            return FileSystemNotes()
 
     def load_attachment_storage(self):
         from attachments.file_system import FileSystemAttachments
@@ -101,6 +119,81 @@ class GlobalConfig:
             sys.exit(1)
         return value
 
+    def _load_attachment_max_size(self):
+        key = "FLATNOTES_ATTACHMENT_MAX_SIZE_MB"
+        value = get_env(key, mandatory=False, default=None, cast_int=True)
+        if value is None:
+            return None
+        if value <= 0:
+            logger.error(
+                f"Invalid value '{value}' for {key}. "
+                + "Must be greater than 0."
+            )
+            sys.exit(1)
+        return value * 1024 * 1024
+
+    def _load_metrics_enabled(self):
+        key = "FLATNOTES_METRICS_ENABLED"
+        return get_env(key, mandatory=False, default=False, cast_bool=True)
+
+    def _load_metrics_auth(self):
+        key = "FLATNOTES_METRICS_AUTH"
+        return get_env(key, mandatory=False, default=True, cast_bool=True)
+
+    def _load_search_backend(self):
+        key = "FLATNOTES_SEARCH_BACKEND"
+        value = get_env(key, mandatory=False, default="whoosh").lower()
+        valid_values = ["whoosh", "sqlite"]
+        if value not in valid_values:
+            logger.error(
+                f"Invalid value '{value}' for {key}. "
+                + "Must be one of: "
+                + ", ".join(valid_values)
+            )
+            sys.exit(1)
+        return value
+
+    def _load_profiling_mode(self):
+        key = "FLATNOTES_PROFILING"
+        value = get_env(key, mandatory=False, default="off").lower()
+        valid_values = ["off", "header", "all"]
+        if value not in valid_values:
+            logger.error(
+                f"Invalid value '{value}' for {key}. "
+                + "Must be one of: "
+                + ", ".join(valid_values)
+            )
+            sys.exit(1)
+        return value
+
+    def _load_profiling_threshold(self):
+        key = "FLATNOTES_PROFILING_THRESHOLD_MS"
+        value = get_env(key, mandatory=False, default=500, cast_int=True)
+        return value / 1000
+
+    def _load_profiling_keep(self):
+        key = "FLATNOTES_PROFILING_KEEP"
+        value = get_env(key, mandatory=False, default=20, cast_int=True)
+        if value < 1:
+            logger.error(
+                f"Invalid value '{value}' for {key}. "
+                + "Must be greater than 0."
+            )
+            sys.exit(1)
+        return value
+
+    def _load_profiling_path(self):
+        key = "FLATNOTES_PROFILING_PATH"
+        return get_env(
+            key,
+            mandatory=False,
+            default=os.path.join(
+                get_env("FLATNOTES_PATH", mandatory=True),
+                ".flatnotes",
+                "profiles",
+            ),
+        )
+
 
 class AuthType(str, Enum):
     NONE = "none"
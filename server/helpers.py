@@ -1,6 +1,13 @@
+import asyncio
+import contextvars
+import functools
 import os
 import re
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import AsyncIterator, Iterator, Optional
 
 from pydantic import BaseModel
 
@@ -60,20 +67,117 @@ def get_env(
     return value
 
 
-def replace_base_href(html_file, path_prefix):
-    """Replace the href value for the base element in an HTML file."""
+def etag_matches(header: Optional[str], etag: str, weak: bool = False) -> bool:
+    """Return True if the given If-Match or If-None-Match header value
+    matches the given entity tag. Weak entity tags only match if `weak` is
+    True, as If-Match requires a strong comparison and If-None-Match a weak
+    one."""
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def replace_base_href(html: str, path_prefix: str) -> str:
+    """Return the given HTML with the href value for the base element
+    replaced."""
     base_path = path_prefix + "/"
-    logger.info(
-        f"Replacing href value for base element in '{html_file}' "
-        + f"with '{base_path}'."
-    )
-    with open(html_file, "r", encoding="utf-8") as f:
-        html = f.read()
+    logger.info(f"Replacing href value for base element with '{base_path}'.")
     pattern = r'(<base\s+href=")[^"]*(")'
     replacement = r"\1" + base_path + r"\2"
-    updated_html = re.sub(pattern, replacement, html, flags=re.IGNORECASE)
-    with open(html_file, "w", encoding="utf-8") as f:
-        f.write(updated_html)
+    return re.sub(pattern, replacement, html, flags=re.IGNORECASE)
+
+
+async def run_in_executor(executor: Executor, func, *args, **kwargs):
+    """Run a blocking function in the given executor and await the result.
+    The function is run in a copy of the current context so that context
+    variables (e.g. request timings) are available to it."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor,
+        functools.partial(context.run, func, *args, **kwargs),
+    )
+
+
+async def iterate_in_executor(
+    executor: Executor, iterator: Iterator
+) -> AsyncIterator:
+    """Iterate over a blocking iterator in the given executor."""
+    sentinel = object()
+    try:
+        while True:
+            item = await run_in_executor(executor, next, iterator, sentinel)
+            if item is sentinel:
+                return
+            yield item
+    finally:
+        # Close generators that aren't exhausted e.g. if the client of a
+        # streaming response disconnects
+        if hasattr(iterator, "close"):
+            await run_in_executor(executor, iterator.close)
+
+
+class LRUCache:
+    """A thread-safe, least recently used cache. The cache is bounded by the
+    total size of its values, as measured by `sizeof`, which defaults to 1
+    per value (i.e. the cache is bounded by the number of values)."""
+
+    def __init__(self, max_size: int, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda _: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return the cached value for `key` or `default` if not cached."""
+        with self._lock:
+            try:
+                value, _ = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        """Cache `value` for `key`, evicting the least recently used values
+        as needed. Values larger than the cache itself are not cached."""
+        size = self.sizeof(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_size:
+                return
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._pop(next(iter(self._items)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def _pop(self, key) -> None:
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
 
 
 class CustomBaseModel(BaseModel):
@@ -29,3 +29,8 @@ uvicorn_logger.addFilter(HealthEndpointFilter())
 for handler in uvicorn_logger.handlers:
     handler.setFormatter(formatter)
 uvicorn_logger.setLevel(log_level)
+
+
+# Watchfiles
+# Note: watchfiles logs every batch of changes at INFO level.
+logging.getLogger("watchfiles").setLevel(logging.WARNING)
@@ -1,18 +1,36 @@
-from typing import List, Literal
-
-from fastapi import APIRouter, Depends, FastAPI, HTTPException, UploadFile
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from typing import AsyncIterator, Dict, List, Literal, Optional, Union
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.security.utils import get_authorization_scheme_param
+from starlette.datastructures import UploadFile as StarletteUploadFile
 
 import api_messages
+import metrics
+import timing
 from attachments.base import BaseAttachments
-from attachments.models import AttachmentCreateResponse
+from attachments.models import (
+    AttachmentCreateResponse,
+    AttachmentUpload,
+    AttachmentUploadCreate,
+)
 from auth.base import BaseAuth
 from auth.models import Login, Token
 from global_config import AuthType, GlobalConfig, GlobalConfigResponseModel
-from helpers import replace_base_href
+from helpers import etag_matches
 from notes.base import BaseNotes
 from notes.models import Note, NoteCreate, NoteUpdate, SearchResult
+from request_profiling import ProfilingMiddleware
+from static_files import PrecompressedStaticFiles
 
 global_config = GlobalConfig()
 auth: BaseAuth = global_config.load_auth()
@@ -24,7 +42,37 @@ app = FastAPI(
     docs_url=global_config.path_prefix + "/docs",
     openapi_url=global_config.path_prefix + "/openapi.json",
 )
-replace_base_href("client/dist/index.html", global_config.path_prefix)
+if global_config.metrics_enabled:
+    app.add_middleware(metrics.MetricsMiddleware)
+if global_config.profiling_mode != "off":
+
+    def is_authenticated(request: Request) -> bool:
+        """Return True if the request is authenticated, for use outside of
+        the route dependencies."""
+        if auth is None:
+            return True
+        scheme, token = get_authorization_scheme_param(
+            request.headers.get("Authorization")
+        )
+        try:
+            auth.authenticate(
+                request, token if scheme.lower() == "bearer" else None
+            )
+        except HTTPException:
+            return False
+        return True
+
+    app.add_middleware(
+        ProfilingMiddleware,
+        path=global_config.profiling_path,
+        mode=global_config.profiling_mode,
+        threshold=global_config.profiling_threshold,
+        keep=global_config.profiling_keep,
+        is_authenticated=is_authenticated,
+    )
+static_files = PrecompressedStaticFiles(
+    directory="client/dist", path_prefix=global_config.path_prefix
+)
 
 
 # region UI
@@ -33,10 +81,8 @@ replace_base_href("client/dist/index.html", global_config.path_prefix)
 @router.get("/search", include_in_schema=False)
 @router.get("/new", include_in_schema=False)
 @router.get("/note/{title}", include_in_schema=False)
-def root(title: str = ""):
-    with open("client/dist/index.html", "r", encoding="utf-8") as f:
-        html = f.read()
-    return HTMLResponse(content=html)
+def root(request: Request, title: str = ""):
+    return static_files.cached_response("index.html", request.scope)
 
 
 # endregion
@@ -72,16 +118,29 @@ def auth_check() -> str:
     dependencies=auth_deps,
     response_model=Note,
 )
-def get_note(title: str):
-    """Get a specific note."""
+async def get_note(
+    title: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
+    """Get a specific note. If the note is unchanged since the version given
+    in the If-None-Match header, a 304 response is returned instead."""
     try:
-        return note_storage.get(title)
+        # Note: The ETag is taken before the note is read so that, if the
+        # note changes in between, the client just fetches it again.
+        etag = await note_storage.get_etag_async(title)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(if_none_match, etag, weak=True):
+            return Response(status_code=304, headers=headers)
+        note = await note_storage.get_async(title)
     except ValueError:
         raise HTTPException(
             status_code=400, detail=api_messages.invalid_note_title
         )
     except FileNotFoundError:
         raise HTTPException(404, api_messages.note_not_found)
+    response.headers.update(headers)
+    return note
 
 
 if global_config.auth_type != AuthType.READ_ONLY:
@@ -92,10 +151,15 @@ if global_config.auth_type != AuthType.READ_ONLY:
         dependencies=auth_deps,
         response_model=Note,
     )
-    def post_note(note: NoteCreate):
-        """Create a new note."""
+    async def post_note(data: NoteCreate, response: Response):
+        """Create a new note. The ETag header is set to the version of the
+        created note."""
         try:
-            return note_storage.create(note)
+            note = await note_storage.create_async(data)
+            response.headers["ETag"] = await note_storage.get_etag_async(
+                note.title
+            )
+            return note
         except ValueError:
             raise HTTPException(
                 status_code=400,
@@ -112,9 +176,25 @@ if global_config.auth_type != AuthType.READ_ONLY:
         dependencies=auth_deps,
         response_model=Note,
     )
-    def patch_note(title: str, data: NoteUpdate):
+    async def patch_note(
+        title: str,
+        data: NoteUpdate,
+        response: Response,
+        if_match: Optional[str] = Header(None),
+    ):
+        """Update a specific note. If an If-Match header is given, the note
+        is only updated if it is unchanged since that version. The ETag
+        header is set to the version of the updated note."""
         try:
-            return note_storage.update(title, data)
+            if if_match is not None and not etag_matches(
+                if_match, await note_storage.get_etag_async(title)
+            ):
+                raise HTTPException(412, api_messages.note_modified)
+            note = await note_storage.update_async(title, data)
+            response.headers["ETag"] = await note_storage.get_etag_async(
+                note.title
+            )
+            return note
         except ValueError:
             raise HTTPException(
                 status_code=400,
@@ -133,9 +213,9 @@ if global_config.auth_type != AuthType.READ_ONLY:
         dependencies=auth_deps,
         response_model=None,
     )
-    def delete_note(title: str):
+    async def delete_note(title: str):
         try:
-            note_storage.delete(title)
+            await note_storage.delete_async(title)
         except ValueError:
             raise HTTPException(
                 status_code=400,
@@ -154,26 +234,76 @@ if global_config.auth_type != AuthType.READ_ONLY:
     dependencies=auth_deps,
     response_model=List[SearchResult],
 )
-def search(
+async def search(
+    response: Response,
     term: str,
     sort: Literal["score", "title", "lastModified"] = "score",
     order: Literal["asc", "desc"] = "desc",
-    limit: int = None,
+    limit: int = Query(None, ge=1),
+    offset: int = Query(0, ge=0),
+    stream: bool = False,
+    highlights: bool = True,
 ):
-    """Perform a full text search on all notes."""
+    """Perform a full text search on all notes. Use `limit` and `offset` to
+    paginate the results. Specify `stream=true` to receive the results as
+    newline delimited JSON, sent as each result is ready. Specify
+    `highlights=false` to skip highlighting, the highlights can then be
+    fetched separately using `/api/search/highlights`. Unless streamed, the
+    response includes a Server-Timing header with the duration of each phase
+    of the search."""
     if sort == "lastModified":
         sort = "last_modified"
-    return note_storage.search(term, sort=sort, order=order, limit=limit)
+    if stream:
+        results = note_storage.iter_search_async(
+            term,
+            sort=sort,
+            order=order,
+            limit=limit,
+            offset=offset,
+            highlights=highlights,
+        )
+        return StreamingResponse(
+            (
+                result.model_dump_json(by_alias=True) + "\n"
+                async for result in results
+            ),
+            media_type="application/x-ndjson",
+        )
+    timings = timing.start()
+    results = await note_storage.search_async(
+        term,
+        sort=sort,
+        order=order,
+        limit=limit,
+        offset=offset,
+        highlights=highlights,
+    )
+    response.headers["Server-Timing"] = timings.header()
+    return results
+
+
+@router.get(
+    "/api/search/highlights",
+    dependencies=auth_deps,
+    response_model=List[SearchResult],
+)
+async def search_highlights(term: str, titles: List[str] = Query()):
+    """Get the search results, including highlights, for the given term
+    limited to the given note titles."""
+    return await note_storage.get_highlights_async(term, titles)
 
 
 @router.get(
     "/api/tags",
     dependencies=auth_deps,
-    response_model=List[str],
+    response_model=Union[List[str], Dict[str, int]],
 )
-def get_tags():
-    """Get a list of all indexed tags."""
-    return note_storage.get_tags()
+async def get_tags(counts: bool = False):
+    """Get a list of all indexed tags. Specify `counts=true` to instead get
+    an object mapping each tag to the number of notes using it."""
+    if counts:
+        return await note_storage.get_tag_counts_async()
+    return await note_storage.get_tags_async()
 
 
 # endregion
@@ -209,10 +339,12 @@ def get_config():
     dependencies=auth_deps,
     include_in_schema=False,
 )
-def get_attachment(filename: str):
-    """Download an attachment."""
+async def get_attachment(filename: str, w: Optional[int] = Query(None, gt=0)):
+    """Download an attachment. For images, a maximum width can be given in
+    the "w" query parameter to download a resized copy, which is generated
+    on the first request and then cached."""
     try:
-        return attachment_storage.get(filename)
+        return await attachment_storage.get_async(filename, width=w)
     except ValueError:
         raise HTTPException(
             status_code=400,
@@ -231,11 +363,61 @@ if global_config.auth_type != AuthType.READ_ONLY:
         "/api/attachments",
         dependencies=auth_deps,
         response_model=AttachmentCreateResponse,
+        openapi_extra={
+            "requestBody": {
+                "required": True,
+                "content": {
+                    "multipart/form-data": {
+                        "schema": {
+                            "type": "object",
+                            "properties": {
+                                "file": {"type": "string", "format": "binary"}
+                            },
+                            "required": ["file"],
+                        }
+                    },
+                    "application/octet-stream": {
+                        "schema": {"type": "string", "format": "binary"}
+                    },
+                },
+            }
+        },
     )
-    def post_attachment(file: UploadFile):
-        """Upload an attachment."""
+    async def post_attachment(
+        request: Request,
+        filename: Optional[str] = None,
+        content_length: Optional[int] = Header(None),
+    ):
+        """Upload an attachment, either as a multipart form with a single
+        "file" field or as the raw request body with the filename given in
+        the "filename" query parameter. The raw body is streamed straight to
+        disk."""
+        max_size = global_config.attachment_max_size
+        if (
+            max_size is not None
+            and content_length is not None
+            and content_length > max_size
+        ):
+            raise HTTPException(413, api_messages.attachment_too_large)
+        content_type = request.headers.get("content-type", "")
         try:
-            return attachment_storage.create(file)
+            if content_type.startswith("multipart/form-data"):
+                # Note: The size of a multipart upload can only be enforced
+                # before it is read if the Content-Length is given.
+                if max_size is not None and content_length is None:
+                    raise HTTPException(411, api_messages.length_required)
+                async with request.form(max_files=1) as form:
+                    file = form.get("file")
+                    if not isinstance(file, StarletteUploadFile):
+                        raise HTTPException(
+                            422, api_messages.attachment_missing
+                        )
+                    return await attachment_storage.create_async(file)
+            if not filename:
+                raise HTTPException(422, api_messages.attachment_missing)
+            return await attachment_storage.create_from_stream_async(
+                filename, _limit_stream(request.stream(), max_size)
+            )
         except ValueError:
             raise HTTPException(
                 status_code=400,
@@ -244,6 +426,114 @@ if global_config.auth_type != AuthType.READ_ONLY:
         except FileExistsError:
             raise HTTPException(409, api_messages.attachment_exists)
 
+    # Create Resumable Upload
+    @router.post(
+        "/api/attachments/uploads",
+        dependencies=auth_deps,
+        response_model=AttachmentUpload,
+    )
+    async def post_attachment_upload(data: AttachmentUploadCreate):
+        """Start a resumable upload of a large attachment. The content is
+        then sent in one or more chunks using the PATCH endpoint."""
+        max_size = global_config.attachment_max_size
+        if max_size is not None and data.size > max_size:
+            raise HTTPException(413, api_messages.attachment_too_large)
+        try:
+            return await attachment_storage.create_upload_async(
+                data.filename, data.size
+            )
+        except ValueError:
+            raise HTTPException(
+                status_code=400,
+                detail=api_messages.invalid_attachment_filename,
+            )
+        except FileExistsError:
+            raise HTTPException(409, api_messages.attachment_exists)
+
+    # Get Resumable Upload
+    @router.get(
+        "/api/attachments/uploads/{upload_id}",
+        dependencies=auth_deps,
+        response_model=AttachmentUpload,
+    )
+    async def get_attachment_upload(upload_id: str):
+        """Get the progress of a resumable upload. The offset is the number
+        of bytes received so far, from which an interrupted upload should be
+        resumed."""
+        try:
+            return await attachment_storage.get_upload_async(upload_id)
+        except FileNotFoundError:
+            raise HTTPException(404, api_messages.upload_not_found)
+
+    # Continue Resumable Upload
+    @router.patch(
+        "/api/attachments/uploads/{upload_id}",
+        dependencies=auth_deps,
+        response_model=AttachmentUpload,
+        openapi_extra={
+            "requestBody": {
+                "required": True,
+                "content": {
+                    "application/octet-stream": {
+                        "schema": {"type": "string", "format": "binary"}
+                    }
+                },
+            }
+        },
+    )
+    async def patch_attachment_upload(
+        request: Request,
+        upload_id: str,
+        upload_offset: int = Header(),
+    ):
+        """Send the next chunk of a resumable upload as the raw request body.
+        The Upload-Offset header must match the upload's current offset.
+        Once all of the content has been received, the attachment is created
+        and included in the response."""
+        try:
+            upload = await attachment_storage.get_upload_async(upload_id)
+            if upload_offset != upload.offset:
+                raise HTTPException(409, api_messages.upload_offset_mismatch)
+            return await attachment_storage.write_upload_async(
+                upload_id,
+                upload_offset,
+                _limit_stream(request.stream(), upload.size - upload.offset),
+            )
+        except FileNotFoundError:
+            raise HTTPException(404, api_messages.upload_not_found)
+        except FileExistsError:
+            raise HTTPException(409, api_messages.attachment_exists)
+
+    async def _limit_stream(
+        stream: AsyncIterator[bytes], max_size: Optional[int]
+    ) -> AsyncIterator[bytes]:
+        """Pass through the chunks of a request body, aborting the request
+        as soon as more than `max_size` bytes have been received."""
+        received = 0
+        async for chunk in stream:
+            received += len(chunk)
+            if max_size is not None and received > max_size:
+                raise HTTPException(413, api_messages.attachment_too_large)
+            yield chunk
+
+
+# endregion
+
+
+# region Metrics
+if global_config.metrics_enabled:
+
+    @router.get(
+        "/metrics",
+        dependencies=auth_deps if global_config.metrics_auth else [],
+        response_class=PlainTextResponse,
+    )
+    def get_metrics():
+        """Metrics in the Prometheus text format."""
+        return PlainTextResponse(
+            metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE
+        )
+
 
 # endregion
 
@@ -261,6 +551,6 @@ def healthcheck() -> str:
 app.include_router(router, prefix=global_config.path_prefix)
 app.mount(
     global_config.path_prefix,
-    StaticFiles(directory="client/dist"),
+    static_files,
     name="dist",
 )
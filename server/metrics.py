@@ -0,0 +1,319 @@
+"""A minimal implementation of Prometheus metrics (counters, gauges and
+histograms) rendered in the Prometheus text exposition format.
+
+Note: Metrics are held in memory per process. When running multiple workers,
+each scrape is answered by one of them."""
+
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from starlette.staticfiles import StaticFiles
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Expected labels {self.labelnames} for {self.name}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(
+        self, values: LabelValues, extra: Optional[Tuple[str, str]] = None
+    ) -> str:
+        pairs = list(zip(self.labelnames, values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return (
+            "{"
+            + ",".join(
+                f'{name}="{_escape_label_value(value)}"'
+                for name, value in pairs
+            )
+            + "}"
+        )
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """Return the lines of the exposition format for each sample."""
+        pass
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    """A gauge whose value is either set directly or, if a function is
+    given, read from the function whenever the metrics are rendered."""
+
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function: Optional[Callable[[], float]] = None
+        self._value: float = 0
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def samples(self) -> List[str]:
+        value = self._value
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                return []
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(*args)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label values: the count for each bucket and the sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * len(self.buckets), [0.0])
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the time taken by the body of a with statement."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total[0]))
+                for key, (counts, total) in self._values.items()
+            )
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = self._format_labels(key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = self._format_labels(key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(
+            metric.render() for metric in self._metrics.values()
+        ) + ("\n" if self._metrics else "")
+
+
+class MetricsMiddleware:
+    """ASGI middleware that records the duration of every HTTP request,
+    labelled by the path template of the route that handled it."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start_time = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_duration.observe(
+                time.perf_counter() - start_time,
+                method=scope["method"],
+                route=self._route_label(scope),
+                status=str(status),
+            )
+
+    @staticmethod
+    def _route_label(scope: Scope) -> str:
+        route = scope.get("route")
+        if route is not None:
+            return route.path
+        # Mounted apps don't set a route
+        if isinstance(scope.get("endpoint"), StaticFiles):
+            return "static"
+        return "other"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+# HTTP
+request_duration = REGISTRY.register(
+    Histogram(
+        "flatnotes_http_request_duration_seconds",
+        "Duration of HTTP requests.",
+        ("method", "route", "status"),
+    )
+)
+
+# Search
+search_phase_duration = REGISTRY.register(
+    Histogram(
+        "flatnotes_search_phase_duration_seconds",
+        "Duration of each phase of a search: bringing the index up to date "
+        + "(sync), parsing the query (parse), running it against the index "
+        + "(search) and building the results, including highlights "
+        + "(results).",
+        ("phase",),
+    )
+)
+search_cache_requests = REGISTRY.register(
+    Counter(
+        "flatnotes_search_cache_requests_total",
+        "Searches answered from (hit) or missing from (miss) the search "
+        + "cache.",
+        ("result",),
+    )
+)
+
+# Index
+index_sync_duration = REGISTRY.register(
+    Histogram(
+        "flatnotes_index_sync_duration_seconds",
+        "Duration of index updates: a full sync with the notes directory "
+        + "(full), a rebuild (build), a batch of changes (changes) or an "
+        + "optimization (optimize).",
+        ("type",),
+        buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+    )
+)
+index_files_checked = REGISTRY.register(
+    Counter(
+        "flatnotes_index_files_checked_total",
+        "Note files checked (stat'd) for changes while syncing the index.",
+    )
+)
+index_documents_changed = REGISTRY.register(
+    Counter(
+        "flatnotes_index_documents_changed_total",
+        "Documents added to, updated in or removed from the index.",
+        ("action",),
+    )
+)
+index_lock_retries = REGISTRY.register(
+    Counter(
+        "flatnotes_index_lock_retries_total",
+        "Attempts to write to the index that found it locked and were "
+        + "retried.",
+        ("operation",),
+    )
+)
+notes_total = REGISTRY.register(
+    Gauge("flatnotes_notes", "Number of notes in the index.")
+)
+index_segments = REGISTRY.register(
+    Gauge("flatnotes_index_segments", "Number of segments in the index.")
+)
+index_size_bytes = REGISTRY.register(
+    Gauge("flatnotes_index_size_bytes", "Size of the index on disk.")
+)
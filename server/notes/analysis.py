@@ -0,0 +1,68 @@
+import re
+from typing import FrozenSet, NamedTuple, Tuple
+
+TAGS_RE = re.compile(r"(?:(?<=^#)|(?<=\s#))[a-zA-Z0-9_-]+(?=\s|$)")
+CODEBLOCK_RE = re.compile(r"`{1,3}.*?`{1,3}", re.DOTALL)
+
+# A single pattern used to tokenize a note in one pass. Code blocks are
+# matched first so that nothing inside them is treated as a tag, heading or
+# link. Every alternative starts with a literal character (the context
+# before a "#" is checked with lookbehinds after it) so that the regex
+# engine can skip quickly through plain text. Headings and links are
+# captured using lookaheads so that they don't consume any text that could
+# contain a code block or tag.
+NOTE_RE = re.compile(
+    r"(?P<codeblock>" + CODEBLOCK_RE.pattern + r")"
+    r"|#(?:"
+    r"(?<![^\n]#)(?=#{0,5}[ \t]+(?P<heading>[^\n]*))"
+    r"|(?<!\S#)(?P<tag>[a-zA-Z0-9_-]+)(?=\s|$)"
+    r")"
+    r"|\[\[(?=(?P<link>[^\[\]\n]+)\]\])",
+    re.DOTALL,
+)
+
+
+class NoteAnalysis(NamedTuple):
+    content_ex_tags: str
+    tags: FrozenSet[str]
+    headings: Tuple[str, ...]
+    links: Tuple[str, ...]
+
+
+def analyse_note(content: str) -> NoteAnalysis:
+    """Tokenize the given note content in a single pass and return:
+
+    - The content without the tags.
+    - A set of tags (excluding any in code blocks) converted to lowercase.
+    - The text of each heading (excluding any in code blocks).
+    - The target of each wikilink (excluding any in code blocks)."""
+    parts = []
+    tags = set()
+    headings = []
+    links = []
+    position = 0
+    for match in NOTE_RE.finditer(content):
+        kind = match.lastgroup
+        start, end = match.span()
+        if kind == "codeblock":
+            # Tags are stripped from code blocks but not extracted
+            parts.append(content[position:start])
+            parts.append(TAGS_RE.sub("", match.group()))
+            position = end
+        elif kind == "tag":
+            # Note: The "#" is left in place
+            tag_start = match.start("tag")
+            parts.append(content[position:tag_start])
+            tags.add(match.group("tag").lower())
+            position = end
+        elif kind == "heading":
+            headings.append(match.group("heading").strip(" \t#"))
+        elif kind == "link":
+            links.append(match.group("link"))
+    parts.append(content[position:])
+    return NoteAnalysis(
+        content_ex_tags="".join(parts),
+        tags=frozenset(tags),
+        headings=tuple(headings),
+        links=tuple(links),
+    )
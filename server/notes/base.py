@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Literal
+from typing import AsyncIterator, Iterator, Literal
+
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 
 from .models import Note, NoteCreate, NoteUpdate, SearchResult
 
@@ -15,6 +17,12 @@ class BaseNotes(ABC):
         """Get a specific note."""
         pass
 
+    @abstractmethod
+    def get_etag(self, title: str) -> str:
+        """Get an entity tag for the current version of a specific note
+        without reading it."""
+        pass
+
     @abstractmethod
     def update(self, title: str, new_data: NoteUpdate) -> Note:
         """Update a specific note."""
@@ -32,11 +40,128 @@ class BaseNotes(ABC):
         sort: Literal["score", "title", "last_modified"] = "score",
         order: Literal["asc", "desc"] = "desc",
         limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
     ) -> list[SearchResult]:
         """Search for notes."""
         pass
 
+    def iter_search(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> Iterator[SearchResult]:
+        """Search for notes, yielding each result as soon as it is ready.
+        Implementations that can produce results incrementally should
+        override this."""
+        yield from self.search(
+            term,
+            sort=sort,
+            order=order,
+            limit=limit,
+            offset=offset,
+            highlights=highlights,
+        )
+
+    @abstractmethod
+    def get_highlights(
+        self, term: str, titles: list[str]
+    ) -> list[SearchResult]:
+        """Get the search results, including highlights, for the given term
+        limited to the given note titles."""
+        pass
+
     @abstractmethod
     def get_tags(self) -> list[str]:
         """Get a list of all indexed tags."""
         pass
+
+    @abstractmethod
+    def get_tag_counts(self) -> dict[str, int]:
+        """Get the number of notes using each indexed tag."""
+        pass
+
+    # Async Variants
+    # Note: These default to running the synchronous methods in Starlette's
+    # threadpool. Implementations should override them where they can avoid
+    # blocking I/O or want to run expensive work elsewhere.
+    async def create_async(self, data: NoteCreate) -> Note:
+        """Create a new note."""
+        return await run_in_threadpool(self.create, data)
+
+    async def get_async(self, title: str) -> Note:
+        """Get a specific note."""
+        return await run_in_threadpool(self.get, title)
+
+    async def get_etag_async(self, title: str) -> str:
+        """Get an entity tag for the current version of a specific note
+        without reading it."""
+        return await run_in_threadpool(self.get_etag, title)
+
+    async def update_async(self, title: str, new_data: NoteUpdate) -> Note:
+        """Update a specific note."""
+        return await run_in_threadpool(self.update, title, new_data)
+
+    async def delete_async(self, title: str) -> None:
+        """Delete a specific note."""
+        return await run_in_threadpool(self.delete, title)
+
+    async def search_async(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> list[SearchResult]:
+        """Search for notes."""
+        return await run_in_threadpool(
+            self.search,
+            term,
+            sort=sort,
+            order=order,
+            limit=limit,
+            offset=offset,
+            highlights=highlights,
+        )
+
+    def iter_search_async(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> AsyncIterator[SearchResult]:
+        """Search for notes, yielding each result as soon as it is ready."""
+        return iterate_in_threadpool(
+            self.iter_search(
+                term,
+                sort=sort,
+                order=order,
+                limit=limit,
+                offset=offset,
+                highlights=highlights,
+            )
+        )
+
+    async def get_highlights_async(
+        self, term: str, titles: list[str]
+    ) -> list[SearchResult]:
+        """Get the search results, including highlights, for the given term
+        limited to the given note titles."""
+        return await run_in_threadpool(self.get_highlights, term, titles)
+
+    async def get_tags_async(self) -> list[str]:
+        """Get a list of all indexed tags."""
+        return await run_in_threadpool(self.get_tags)
+
+    async def get_tag_counts_async(self) -> dict[str, int]:
+        """Get the number of notes using each indexed tag."""
+        return await run_in_threadpool(self.get_tag_counts)
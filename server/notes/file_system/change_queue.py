@@ -0,0 +1,76 @@
+import atexit
+import json
+import os
+import threading
+import uuid
+from typing import Callable, Iterable, Optional, Set
+
+from logger import logger
+
+
+class ChangeQueue:
+    """Pass the filenames of notes changed by processes that aren't
+    maintaining the index to the process that is, through files in a
+    directory shared by all workers. This means changes are indexed promptly
+    even if the notes directory isn't being watched.
+
+    Each batch of changes is written to its own file which the indexer
+    polls for, applies and then removes."""
+
+    POLL_INTERVAL = 0.1
+    EXT = ".json"
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self._on_changes: Optional[Callable[[Set[str]], None]] = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="flatnotes-change-queue", daemon=True
+        )
+
+    def put(self, filenames: Iterable[str]) -> None:
+        """Queue the given note filenames to be synced by the indexer."""
+        name = uuid.uuid4().hex
+        temp_path = os.path.join(self.path, f".{name}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(list(filenames), f)
+        # Note: The file is renamed into place so that the indexer never
+        # reads a partially written batch
+        os.replace(temp_path, os.path.join(self.path, name + self.EXT))
+
+    def start(self, on_changes: Callable[[Set[str]], None]) -> None:
+        """Start reporting queued note filenames to `on_changes`."""
+        self._on_changes = on_changes
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+    def _take(self) -> Set[str]:
+        """Return the queued note filenames, removing them from the
+        queue."""
+        filenames = set()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not entry.name.endswith(self.EXT):
+                    continue
+                try:
+                    with open(entry.path, encoding="utf-8") as f:
+                        filenames.update(json.load(f))
+                except ValueError as e:
+                    logger.error(f"Ignoring invalid queued changes: {e}")
+                os.remove(entry.path)
+        return filenames
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.POLL_INTERVAL):
+            try:
+                filenames = self._take()
+                if filenames:
+                    self._on_changes(filenames)
+            except Exception as e:
+                logger.error(f"Failed to read queued changes: {e}")
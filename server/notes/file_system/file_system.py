@@ -1,31 +1,45 @@
-import glob
 import os
-import re
 import shutil
+import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List, Literal, Set, Tuple
+from typing import Dict, Iterable, Iterator, List, Literal, Optional, Tuple
 
 import whoosh
 from whoosh import writing
 from whoosh.analysis import CharsetFilter, StemmingAnalyzer
 from whoosh.fields import DATETIME, ID, KEYWORD, TEXT, SchemaClass
 from whoosh.highlight import ContextFragmenter, WholeFragmenter
-from whoosh.index import Index, LockError
+from whoosh.index import Index
+from whoosh.multiproc import MpWriter
 from whoosh.qparser import MultifieldParser
 from whoosh.qparser.dateparse import DateParserPlugin
-from whoosh.query import Every
-from whoosh.searching import Hit
+from whoosh.query import Every, Or, Query, Term
+from whoosh.searching import Hit, Searcher
 from whoosh.support.charset import accent_map
 
-from helpers import get_env, is_valid_filename
+import metrics
+import timing
+from helpers import get_env
 from logger import logger
 
-from ..base import BaseNotes
-from ..models import Note, NoteCreate, NoteUpdate, SearchResult
+from ..analysis import NoteAnalysis, analyse_note
+from ..models import Note, SearchResult
+from .change_queue import ChangeQueue
+from .index_maintenance import IndexMaintenanceThread
+from .indexer_lock import IndexerLock
+from .markdown_notes import MARKDOWN_EXT, MarkdownNotes
+from .searcher_manager import SearcherManager
+from .tag_index import TagIndex
 
-MARKDOWN_EXT = ".md"
 INDEX_SCHEMA_VERSION = "5"
+INDEXER_LOCK_FILENAME = "indexer.lock"
+# Changes to the tags of notes, keyed by filename, waiting for the index
+# writer to be committed. The value is None if the note was removed.
+TagChanges = Dict[str, Optional[Iterable[str]]]
+CHANGE_QUEUE_DIRNAME = "changes"
 
 StemmingFoldingAnalyzer = StemmingAnalyzer() | CharsetFilter(accent_map)
 
@@ -40,93 +54,86 @@ class IndexSchema(SchemaClass):
     tags = KEYWORD(lowercase=True, field_boost=2.0)
 
 
-class FileSystemNotes(BaseNotes):
-    TAGS_RE = re.compile(r"(?:(?<=^#)|(?<=\s#))[a-zA-Z0-9_-]+(?=\s|$)")
-    CODEBLOCK_RE = re.compile(r"`{1,3}.*?`{1,3}", re.DOTALL)
-    TAGS_WITH_HASH_RE = re.compile(
-        r"(?:(?<=^)|(?<=\s))#[a-zA-Z0-9_-]+(?=\s|$)"
-    )
+class FileSystemNotes(MarkdownNotes):
+    """Notes stored as markdown files and indexed using Whoosh."""
+
+    # How often, in seconds, a process that isn't maintaining the index
+    # checks whether it can take over
+    ELECTION_INTERVAL = 5
 
     def __init__(self):
-        self.storage_path = get_env("FLATNOTES_PATH", mandatory=True)
-        if not os.path.exists(self.storage_path):
-            raise NotADirectoryError(
-                f"'{self.storage_path}' is not a valid directory."
-            )
-        self.index = self._load_index()
-        self._sync_index_with_retry(optimize=True)
-
-    def create(self, data: NoteCreate) -> Note:
-        """Create a new note."""
-        filepath = self._path_from_title(data.title)
-        self._write_file(filepath, data.content)
-        return Note(
-            title=data.title,
-            content=data.content,
-            last_modified=os.path.getmtime(filepath),
+        super().__init__()
+        self.index_workers = get_env(
+            "FLATNOTES_INDEX_WORKERS",
+            mandatory=False,
+            default=1,
+            cast_int=True,
         )
-
-    def get(self, title: str) -> Note:
-        """Get a specific note."""
-        is_valid_filename(title)
-        filepath = self._path_from_title(title)
-        content = self._read_file(filepath)
-        return Note(
-            title=title,
-            content=content,
-            last_modified=os.path.getmtime(filepath),
+        # A searcher shared by all reads of the index
+        self._searchers = SearcherManager(lambda: self.index)
+        self._tag_index = TagIndex()
+        self._tag_index_generation = None
+        self._tag_index_lock = threading.Lock()
+        self._maintenance = None
+        # When running multiple workers, only one process (the indexer)
+        # writes to the index. The others open it read-only.
+        os.makedirs(self._index_path, exist_ok=True)
+        self._indexer_lock = IndexerLock(
+            os.path.join(self._index_path, INDEXER_LOCK_FILENAME)
         )
-
-    def update(self, title: str, data: NoteUpdate) -> Note:
-        """Update a specific note."""
-        is_valid_filename(title)
-        filepath = self._path_from_title(title)
-        if data.new_title is not None:
-            new_filepath = self._path_from_title(data.new_title)
-            if filepath != new_filepath and os.path.isfile(new_filepath):
-                raise FileExistsError(
-                    f"Failed to rename. '{data.new_title}' already exists."
-                )
-            os.rename(filepath, new_filepath)
-            title = data.new_title
-            filepath = new_filepath
-        if data.new_content is not None:
-            self._write_file(filepath, data.new_content, overwrite=True)
-            content = data.new_content
-        else:
-            content = self._read_file(filepath)
-        return Note(
-            title=title,
-            content=content,
-            last_modified=os.path.getmtime(filepath),
+        self._change_queue = ChangeQueue(
+            os.path.join(self._index_path, CHANGE_QUEUE_DIRNAME)
         )
-
-    def delete(self, title: str) -> None:
-        """Delete a specific note."""
-        is_valid_filename(title)
-        filepath = self._path_from_title(title)
-        os.remove(filepath)
-
-    def search(
+        self._is_indexer = False
+        self._election_lock = threading.Lock()
+        self._last_election_time = time.monotonic()
+        # Changes made by this process that are waiting to be indexed by
+        # another process, keyed by filename. The value is the expected
+        # last modified time, or None if the note was removed.
+        self._unindexed_changes: Dict[str, Optional[datetime]] = {}
+        self._unindexed_changes_lock = threading.Lock()
+        metrics.notes_total.set_function(lambda: self.index.doc_count())
+        metrics.index_segments.set_function(
+            lambda: len(self.index._segments())
+        )
+        metrics.index_size_bytes.set_function(self._index_size)
+        waiting_logged = False
+        while True:
+            if self._indexer_lock.acquire():
+                self._start_indexing()
+                break
+            if whoosh.index.exists_in(
+                self._index_path, indexname=INDEX_SCHEMA_VERSION
+            ):
+                logger.info(
+                    "Another process is maintaining the index, "
+                    + "opening it read-only"
+                )
+                self.index = whoosh.index.open_dir(
+                    self._index_path,
+                    indexname=INDEX_SCHEMA_VERSION,
+                    readonly=True,
+                )
+                self._reload_tag_index()
+                break
+            if not waiting_logged:
+                logger.info("Waiting for the index to be created")
+                waiting_logged = True
+            time.sleep(1)
+
+    def _iter_search(
         self,
         term: str,
         sort: Literal["score", "title", "last_modified"] = "score",
         order: Literal["asc", "desc"] = "desc",
         limit: int = None,
-    ) -> Tuple[SearchResult, ...]:
-        """Search the index for the given term."""
-        self._sync_index_with_retry()
-        term = self._pre_process_search_term(term)
-        with self.index.searcher() as searcher:
-            # Parse Query
-            if term == "*":
-                query = Every()
-            else:
-                parser = MultifieldParser(
-                    self._fieldnames_for_term(term), self.index.schema
-                )
-                parser.add_plugin(DateParserPlugin())
-                query = parser.parse(term)
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> Iterator[SearchResult]:
+        """Search the index for the given term, bypassing the cache."""
+        with self._searchers.searcher() as searcher:
+            with self._search_phase("parse"):
+                query = self._parse_search_term(term)
 
             # Determine Sort By
             # Note: For the 'sort' option, "score" is converted to None as
@@ -142,38 +149,256 @@ class FileSystemNotes(BaseNotes):
                 reverse = not reverse
 
             # Run Search
+            # Note: This is how Whoosh's search_page() works but using an
+            # offset rather than a page number.
+            with self._search_phase("search"):
+                results = searcher.search(
+                    query,
+                    sortedby=sort,
+                    reverse=reverse,
+                    limit=None if limit is None else offset + limit,
+                    terms=True,
+                )
+            # Note: Only the time spent building each result is included,
+            # not the time spent by the caller between results.
+            results_duration = 0
+            try:
+                end = None if limit is None else offset + limit
+                for hit in results[offset:end]:
+                    start_time = time.perf_counter()
+                    result = self._search_result_from_hit(
+                        hit, highlights=highlights
+                    )
+                    results_duration += time.perf_counter() - start_time
+                    if result is not None:
+                        yield result
+            finally:
+                metrics.search_phase_duration.observe(
+                    results_duration, phase="results"
+                )
+                timing.add("results", results_duration)
+
+    def get_highlights(
+        self, term: str, titles: List[str]
+    ) -> Tuple[SearchResult, ...]:
+        """Return the search results, including highlights, for the given
+        term limited to the given note titles. Results are returned in the
+        same order as the titles and titles that don't match are omitted."""
+        self._refresh_index()
+        title_filter = Or(
+            [Term("filename", title + MARKDOWN_EXT) for title in titles]
+        )
+        with self._searchers.searcher() as searcher:
             results = searcher.search(
-                query,
-                sortedby=sort,
-                reverse=reverse,
-                limit=limit,
+                self._parse_search_term(term),
+                filter=title_filter,
+                limit=None,
                 terms=True,
             )
-            return tuple(self._search_result_from_hit(hit) for hit in results)
+            search_results = {
+                result.title: result
+                for result in map(self._search_result_from_hit, results)
+                if result is not None
+            }
+        return tuple(
+            search_results[title]
+            for title in dict.fromkeys(titles)
+            if title in search_results
+        )
 
     def get_tags(self) -> list[str]:
-        """Return a list of all indexed tags. Note: Tags no longer in use will
-        only be cleared when the index is next optimized."""
-        self._sync_index_with_retry()
-        with self.index.reader() as reader:
-            tags = reader.field_terms("tags")
-            return [tag for tag in tags]
+        """Return a list of all tags in use."""
+        self._refresh_index()
+        return self._tag_index.tags()
+
+    def get_tag_counts(self) -> dict[str, int]:
+        """Return the number of notes using each tag."""
+        self._refresh_index()
+        return self._tag_index.counts()
+
+    def _index_generation(self) -> int:
+        return self.index.latest_generation()
+
+    def _index_size(self) -> int:
+        """Return the total size, in bytes, of the index files."""
+        with os.scandir(self._index_path) as entries:
+            return sum(
+                entry.stat().st_size for entry in entries if entry.is_file()
+            )
 
-    @property
-    def _index_path(self):
-        return os.path.join(self.storage_path, ".flatnotes")
+    def _load_maintenance(self) -> IndexMaintenanceThread:
+        """Create the index maintenance thread as configured by:
+
+        - FLATNOTES_INDEX_MAX_SEGMENTS
+        - FLATNOTES_INDEX_MAX_DELETED_PERCENT
+        - FLATNOTES_INDEX_IDLE_SECONDS
+        - FLATNOTES_INDEX_MAINTENANCE_HOURS e.g. "1-5" to only optimize the
+          index between 01:00 and 05:00."""
+        key = "FLATNOTES_INDEX_MAINTENANCE_HOURS"
+        value = get_env(key, mandatory=False)
+        hours = None
+        if value:
+            try:
+                hours = tuple(int(hour) for hour in value.split("-"))
+                if len(hours) != 2 or not all(0 <= h <= 24 for h in hours):
+                    raise ValueError
+            except ValueError:
+                logger.error(
+                    f"Invalid value '{value}' for {key}. "
+                    + "Must be a range of hours e.g. 1-5."
+                )
+                sys.exit(1)
+        return IndexMaintenanceThread(
+            lambda: self.index,
+            self._index_writer,
+            max_segments=get_env(
+                "FLATNOTES_INDEX_MAX_SEGMENTS",
+                mandatory=False,
+                default=10,
+                cast_int=True,
+            ),
+            max_deleted_ratio=get_env(
+                "FLATNOTES_INDEX_MAX_DELETED_PERCENT",
+                mandatory=False,
+                default=20,
+                cast_int=True,
+            )
+            / 100,
+            idle_seconds=get_env(
+                "FLATNOTES_INDEX_IDLE_SECONDS",
+                mandatory=False,
+                default=60,
+                cast_int=True,
+            ),
+            hours=hours,
+        )
 
-    def _path_from_title(self, title: str) -> str:
-        return os.path.join(self.storage_path, title + MARKDOWN_EXT)
+    def _start_indexing(self) -> None:
+        """Bring the index up to date and start keeping it up to date. Only
+        called once this process holds the indexer lock."""
+        self.index = self._load_index()
+        self._load_tag_index()
+        self._index_writer = self._load_index_writer()
+        # Start watching before the initial sync so that no changes made
+        # during the sync are missed. They are queued until the index writer
+        # is started.
+        self._watcher = self._load_watcher()
+        self._change_queue.start(
+            on_changes=lambda filenames: self._index_writer.submit(
+                dict.fromkeys(filenames)
+            )
+        )
+        self._sync_index_with_retry()
+        self._index_writer.start()
+        # Note: The index is optimized in the background when it is idle
+        # rather than at startup
+        self._maintenance = self._load_maintenance()
+        self._maintenance.start()
+        with self._unindexed_changes_lock:
+            self._unindexed_changes.clear()
+        self._is_indexer = True
+
+    def _try_take_over_indexing(self) -> bool:
+        """Try to take over maintaining the index e.g. if the process that
+        was maintaining it has exited. Returns True if this process is now
+        the indexer."""
+        with self._election_lock:
+            if self._is_indexer:
+                return True
+            now = time.monotonic()
+            if now - self._last_election_time < self.ELECTION_INTERVAL:
+                return False
+            self._last_election_time = now
+            if not self._indexer_lock.acquire():
+                return False
+            logger.info("Taking over maintenance of the index")
+            self._start_indexing()
+            return True
+
+    def _queue_index_changes(self, changes: Dict[str, Optional[Note]]):
+        """Queue changes made by this process, keyed by filename, to be
+        written to the index. If another process is maintaining the index,
+        the changed filenames are passed to it through the change queue and
+        recorded in order for searches to wait for them."""
+        if self._is_indexer:
+            self._index_writer.submit(changes)
+            return
+        with self._unindexed_changes_lock:
+            for filename, note in changes.items():
+                self._unindexed_changes[filename] = (
+                    None
+                    if note is None
+                    else datetime.fromtimestamp(note.last_modified)
+                )
+        try:
+            self._change_queue.put(changes)
+        except OSError as e:
+            logger.error(f"Failed to queue changes for indexing: {e}")
+
+    def _refresh_index(self) -> None:
+        """Wait for any queued changes to be committed before the index is
+        read. If the notes directory isn't being watched, the whole directory
+        is scanned for changes first."""
+        if not self._is_indexer and not self._try_take_over_indexing():
+            self._refresh_read_only_index()
+            return
+        self._maintenance.touch()
+        if self._watcher is None or not self._watcher.is_alive:
+            self._index_writer.submit_full_sync()
+        if not self._index_writer.flush(timeout=self.INDEX_FLUSH_TIMEOUT):
+            logger.warning(
+                "Timed out waiting for index changes to be committed. "
+                + "Search results may be out of date."
+            )
 
-    def _get_by_filename(self, filename: str) -> Note:
-        """Get a note by its filename."""
-        return self.get(self._strip_ext(filename))
+    def _refresh_read_only_index(self) -> None:
+        """Wait for changes made by this process to be indexed by the process
+        maintaining the index and reload the tag index if the index has
+        changed."""
+        deadline = time.monotonic() + self.INDEX_FLUSH_TIMEOUT
+        while True:
+            with self._unindexed_changes_lock:
+                changes = dict(self._unindexed_changes)
+            if not changes:
+                break
+            with self._searchers.searcher() as searcher:
+                for filename, last_modified in changes.items():
+                    idx_note = searcher.document(filename=filename)
+                    if (last_modified is None and idx_note is None) or (
+                        last_modified is not None
+                        and idx_note is not None
+                        and idx_note["last_modified"] >= last_modified
+                    ):
+                        with self._unindexed_changes_lock:
+                            if (
+                                self._unindexed_changes.get(filename)
+                                == last_modified
+                            ):
+                                del self._unindexed_changes[filename]
+            if time.monotonic() >= deadline:
+                logger.warning(
+                    "Timed out waiting for changes to be indexed. "
+                    + "Search results may be out of date."
+                )
+                with self._unindexed_changes_lock:
+                    self._unindexed_changes.clear()
+                break
+            time.sleep(0.05)
+        if self.index.latest_generation() != self._tag_index_generation:
+            self._reload_tag_index()
+
+    def _reload_tag_index(self) -> None:
+        """Reload the in-memory tag index from an index maintained by another
+        process."""
+        with self._tag_index_lock:
+            generation = self.index.latest_generation()
+            if generation != self._tag_index_generation:
+                self._load_tag_index()
+                self._tag_index_generation = generation
 
     def _load_index(self) -> Index:
         """Load the note index or create new if not exists."""
-        index_dir_exists = os.path.exists(self._index_path)
-        if index_dir_exists and whoosh.index.exists_in(
+        if whoosh.index.exists_in(
             self._index_path, indexname=INDEX_SCHEMA_VERSION
         ):
             logger.info("Loading existing index")
@@ -181,71 +406,114 @@ class FileSystemNotes(BaseNotes):
                 self._index_path, indexname=INDEX_SCHEMA_VERSION
             )
         else:
-            if index_dir_exists:
+            exclude = (INDEXER_LOCK_FILENAME, CHANGE_QUEUE_DIRNAME)
+            if set(os.listdir(self._index_path)) - set(exclude):
                 logger.info("Deleting outdated index")
-                self._clear_dir(self._index_path)
-            else:
-                os.mkdir(self._index_path)
+                self._clear_dir(self._index_path, exclude=exclude)
             logger.info("Creating new index")
             return whoosh.index.create_in(
                 self._index_path, IndexSchema, indexname=INDEX_SCHEMA_VERSION
             )
 
-    @classmethod
-    def _extract_tags(cls, content) -> Tuple[str, Set[str]]:
-        """Strip tags from the given content and return a tuple consisting of:
-
-        - The content without the tags.
-        - A set of tags converted to lowercase."""
-        content_ex_codeblock = re.sub(cls.CODEBLOCK_RE, "", content)
-        _, tags = cls._re_extract(cls.TAGS_RE, content_ex_codeblock)
-        content_ex_tags, _ = cls._re_extract(cls.TAGS_RE, content)
-        try:
-            tags = [tag.lower() for tag in tags]
-            return (content_ex_tags, set(tags))
-        except IndexError:
-            return (content, set())
+    def _load_tag_index(self) -> None:
+        """Load the in-memory tag index from the search index. Note: Tags are
+        looked up using the search index postings rather than the term list
+        as the term list includes tags from deleted documents until the
+        index is next optimized."""
+        tags_by_filename = {}
+        with self._searchers.searcher() as searcher:
+            for tag in searcher.reader().field_terms("tags"):
+                for docnum in searcher.docs_for_query(Term("tags", tag)):
+                    filename = searcher.stored_fields(docnum)["filename"]
+                    tags_by_filename.setdefault(filename, set()).add(tag)
+        self._tag_index.replace(tags_by_filename)
 
     def _add_note_to_index(
-        self, writer: writing.IndexWriter, note: Note
+        self,
+        writer: writing.IndexWriter,
+        tag_changes: TagChanges,
+        note: Note,
+        stat: Optional[os.stat_result] = None,
     ) -> None:
         """Add a Note object to the index using the given writer. If the
         filename already exists in the index an update will be performed
-        instead."""
-        content_ex_tags, tag_set = self._extract_tags(note.content)
-        tag_string = " ".join(tag_set)
-        writer.update_document(
+        instead. Specify the `stat` taken before the note was read to cache
+        its analysis. The note's tags are recorded in `tag_changes`."""
+        analysis = self._analyse_note(
+            note.title + MARKDOWN_EXT, note.content, stat
+        )
+        document = self._document_from_note(note, analysis)
+        writer.update_document(**document)
+        tag_changes[document["filename"]] = analysis.tags
+
+    def _remove_note_from_index(
+        self,
+        writer: writing.IndexWriter,
+        tag_changes: TagChanges,
+        filename: str,
+    ) -> None:
+        """Remove a note from the index using the given writer. The removal
+        is recorded in `tag_changes`."""
+        writer.delete_by_term("filename", filename)
+        tag_changes[filename] = None
+
+    @staticmethod
+    def _document_from_note(note: Note, analysis: NoteAnalysis) -> dict:
+        """Return the index fields for the given Note object."""
+        return dict(
             filename=note.title + MARKDOWN_EXT,
             last_modified=datetime.fromtimestamp(note.last_modified),
             title=note.title,
-            content=content_ex_tags,
-            tags=tag_string,
+            content=analysis.content_ex_tags,
+            tags=" ".join(analysis.tags),
         )
 
-    def _list_all_note_filenames(self) -> List[str]:
-        """Return a list of all note filenames."""
-        return [
-            os.path.split(filepath)[1]
-            for filepath in glob.glob(
-                os.path.join(self.storage_path, "*" + MARKDOWN_EXT)
-            )
-        ]
-
     def _sync_index(self, optimize: bool = False, clean: bool = False) -> None:
         """Synchronize the index with the notes directory.
-        Specify clean=True to completely rebuild the index"""
+        Specify clean=True to completely rebuild the index."""
+        # Note: An empty index is only built in parallel if there are notes
+        # to add, otherwise every sync of an empty directory would commit a
+        # new index generation.
+        if self.index_workers > 1 and (
+            clean
+            or (self.index.is_empty() and self._list_all_note_filenames())
+        ):
+            self._build_index(optimize=optimize)
+            return
+        with metrics.index_sync_duration.time(type="full"):
+            writer = self.index.writer()
+            if clean:
+                writer.mergetype = writing.CLEAR  # Clear the index
+            tag_changes = {}
+            try:
+                changed = self._sync_all_notes(writer, tag_changes) or clean
+            except BaseException:
+                writer.cancel()
+                raise
+            self._finish_sync(writer, changed, tag_changes, optimize=optimize)
+            if clean:
+                self._load_tag_index()
+
+    def _sync_all_notes(
+        self, writer: writing.IndexWriter, tag_changes: TagChanges
+    ) -> bool:
+        """Synchronize the index for every note in the notes directory using
+        the given writer, recording changes to tags in `tag_changes`. Returns
+        True if the index was changed."""
         indexed = set()
-        writer = self.index.writer()
-        if clean:
-            writer.mergetype = writing.CLEAR  # Clear the index
+        checked = removed = updated = added = 0
         with self.index.searcher() as searcher:
             for idx_note in searcher.all_stored_fields():
                 idx_filename = idx_note["filename"]
                 idx_filepath = os.path.join(self.storage_path, idx_filename)
+                checked += 1
                 # Delete missing
                 if not os.path.exists(idx_filepath):
-                    writer.delete_by_term("filename", idx_filename)
+                    self._remove_note_from_index(
+                        writer, tag_changes, idx_filename
+                    )
                     logger.info(f"'{idx_filename}' removed from index")
+                    removed += 1
                 # Update modified
                 elif (
                     datetime.fromtimestamp(os.path.getmtime(idx_filepath))
@@ -253,9 +521,10 @@ class FileSystemNotes(BaseNotes):
                 ):
                     logger.info(f"'{idx_filename}' updated")
                     self._add_note_to_index(
-                        writer, self._get_by_filename(idx_filename)
+                        writer, tag_changes, *self._read_note(idx_filename)
                     )
                     indexed.add(idx_filename)
+                    updated += 1
                 # Ignore already indexed
                 else:
                     indexed.add(idx_filename)
@@ -263,65 +532,206 @@ class FileSystemNotes(BaseNotes):
         for filename in self._list_all_note_filenames():
             if filename not in indexed:
                 self._add_note_to_index(
-                    writer, self._get_by_filename(filename)
+                    writer, tag_changes, *self._read_note(filename)
                 )
                 logger.info(f"'{filename}' added to index")
+                added += 1
+        metrics.index_files_checked.inc(checked)
+        metrics.index_documents_changed.inc(removed, action="removed")
+        metrics.index_documents_changed.inc(updated, action="updated")
+        metrics.index_documents_changed.inc(added, action="added")
+        return bool(removed or updated or added)
+
+    def _build_index(self, optimize: bool = False) -> None:
+        """(Re)build the whole index from scratch. Notes are read and parsed
+        in a pool of FLATNOTES_INDEX_WORKERS processes and indexed using a
+        multiprocess writer."""
+        filepaths = [
+            os.path.join(self.storage_path, filename)
+            for filename in self._list_all_note_filenames()
+        ]
+        total = len(filepaths)
+        logger.info(
+            f"Building index for {total} notes "
+            + f"using {self.index_workers} workers"
+        )
+        start_time = time.monotonic()
+        writer = self.index.writer(
+            procs=self.index_workers, multisegment=not optimize
+        )
+        writer.mergetype = writing.CLEAR
+        tags_by_filename = {}
+        progress_interval = max(total // 10, 1)
+        try:
+            with ProcessPoolExecutor(
+                max_workers=self.index_workers
+            ) as executor:
+                for count, document in enumerate(
+                    executor.map(_load_document, filepaths, chunksize=64),
+                    start=1,
+                ):
+                    writer.add_document(**document)
+                    tags = document["tags"].split()
+                    tags_by_filename[document["filename"]] = tags
+                    if count % progress_interval == 0 or count == total:
+                        logger.info(f"Indexed {count}/{total} notes")
+        except BaseException:
+            self._cancel_build(writer)
+            raise
         writer.commit(optimize=optimize)
-        logger.info("Index synchronized")
+        self._tag_index.replace(tags_by_filename)
+        duration = time.monotonic() - start_time
+        metrics.index_sync_duration.observe(duration, type="build")
+        metrics.index_documents_changed.inc(total, action="added")
+        logger.info(f"Index built in {duration:.1f} seconds")
+
+    @staticmethod
+    def _cancel_build(writer: MpWriter) -> None:
+        """Cancel the multiprocess writer used to build the index. Whoosh
+        only marks its subprocesses as cancelled in this process, leaving them
+        waiting for work (and the interpreter unable to exit), so they are
+        terminated too."""
+        try:
+            writer.cancel()
+        finally:
+            for task in writer.tasks:
+                task.terminate()
+                task.join()
+
+    def _sync_index_changes(self, changes: Dict[str, Optional[Note]]) -> None:
+        """Apply the given changes, keyed by note filename, to the index in a
+        single commit. A change is either the Note to be indexed or None if
+        the note should be synchronized with the notes directory i.e.
+        (re-)indexed if it exists and removed if it doesn't."""
+        start_time = time.perf_counter()
+        changed = False
+        tag_changes = {}
+        writer = self.index.writer()
+        try:
+            with self.index.searcher() as searcher:
+                for filename, note in changes.items():
+                    try:
+                        if note is None:
+                            changed |= self._sync_note(
+                                writer, searcher, tag_changes, filename
+                            )
+                        else:
+                            metrics.index_documents_changed.inc(
+                                action=(
+                                    "added"
+                                    if searcher.document_number(
+                                        filename=filename
+                                    )
+                                    is None
+                                    else "updated"
+                                )
+                            )
+                            self._add_note_to_index(writer, tag_changes, note)
+                            changed = True
+                    except (OSError, ValueError) as e:
+                        logger.error(f"Failed to index '{filename}': {e}")
+        except BaseException:
+            writer.cancel()
+            raise
+        self._finish_sync(writer, changed, tag_changes)
+        metrics.index_sync_duration.observe(
+            time.perf_counter() - start_time, type="changes"
+        )
 
-    def _sync_index_with_retry(
+    def _sync_note(
         self,
+        writer: writing.IndexWriter,
+        searcher: Searcher,
+        tag_changes: TagChanges,
+        filename: str,
+    ) -> bool:
+        """Synchronize the index for the given note filename using the given
+        writer, recording changes to tags in `tag_changes`. Returns True if
+        the index was changed."""
+        idx_note = searcher.document(filename=filename)
+        filepath = os.path.join(self.storage_path, filename)
+        metrics.index_files_checked.inc()
+        try:
+            last_modified = datetime.fromtimestamp(os.path.getmtime(filepath))
+        except FileNotFoundError:
+            if idx_note is None:
+                return False
+            self._remove_note_from_index(writer, tag_changes, filename)
+            metrics.index_documents_changed.inc(action="removed")
+            logger.info(f"'{filename}' removed from index")
+            return True
+        # Ignore already indexed e.g. changes written through by this process
+        if idx_note is not None and idx_note["last_modified"] == last_modified:
+            return False
+        self._add_note_to_index(
+            writer, tag_changes, *self._read_note(filename)
+        )
+        metrics.index_documents_changed.inc(
+            action="added" if idx_note is None else "updated"
+        )
+        logger.info(f"'{filename}' indexed")
+        return True
+
+    def _finish_sync(
+        self,
+        writer: writing.IndexWriter,
+        changed: bool,
+        tag_changes: TagChanges,
         optimize: bool = False,
-        clean: bool = False,
-        max_retries: int = 8,
-        retry_delay: float = 0.25,
     ) -> None:
-        for _ in range(max_retries):
-            try:
-                self._sync_index(optimize=optimize, clean=clean)
-                return
-            except LockError:
-                logger.warning(f"Index locked, retrying in {retry_delay}s")
-                time.sleep(retry_delay)
-        logger.error(f"Failed to sync index after {max_retries} retries")
-
-    @classmethod
-    def _pre_process_search_term(cls, term):
-        term = term.strip()
-        # Replace "#tagname" with "tags:tagname"
-        term = re.sub(
-            cls.TAGS_WITH_HASH_RE,
-            lambda tag: "tags:" + tag.group(0)[1:],
-            term,
+        """Commit the writer used to sync the index and then apply the
+        changes to tags to the tag index, so that it never includes changes
+        that weren't committed. If nothing changed, the writer is cancelled
+        instead so that a new index generation isn't created
+        unnecessarily."""
+        if changed or optimize:
+            writer.commit(optimize=optimize)
+            for filename, tags in tag_changes.items():
+                if tags is None:
+                    self._tag_index.remove(filename)
+                else:
+                    self._tag_index.set(filename, tags)
+            logger.info("Index synchronized")
+        else:
+            writer.cancel()
+
+    def _optimize_index(self) -> None:
+        """Merge all index segments into one, purging deleted documents."""
+        start_time = time.monotonic()
+        self.index.optimize()
+        duration = time.monotonic() - start_time
+        metrics.index_sync_duration.observe(duration, type="optimize")
+        logger.info(f"Index optimized in {duration:.1f} seconds")
+
+    def _parse_search_term(self, term: str) -> Query:
+        """Return a Whoosh query for the given search term."""
+        term = self._pre_process_search_term(term)
+        if term == "*":
+            return Every()
+        parser = MultifieldParser(
+            self._fieldnames_for_term(term), self.index.schema
         )
-        return term
-
-    @staticmethod
-    def _re_extract(pattern, string) -> Tuple[str, List[str]]:
-        """Similar to re.sub but returns a tuple of:
-
-        - `string` with matches removed
-        - list of matches"""
-        matches = []
-        text = re.sub(pattern, lambda tag: matches.append(tag.group()), string)
-        return (text, matches)
+        parser.add_plugin(DateParserPlugin())
+        return parser.parse(term)
 
     @staticmethod
-    def _strip_ext(filename):
-        """Return the given filename without the extension."""
-        return os.path.splitext(filename)[0]
-
-    @staticmethod
-    def _clear_dir(path):
-        """Delete all contents of the given directory."""
+    def _clear_dir(path, exclude=()):
+        """Delete all contents of the given directory, except for any items
+        named in `exclude`."""
         for item in os.listdir(path):
+            if item in exclude:
+                continue
             item_path = os.path.join(path, item)
             if os.path.isfile(item_path):
                 os.remove(item_path)
             elif os.path.isdir(item_path):
                 shutil.rmtree(item_path)
 
-    def _search_result_from_hit(self, hit: Hit):
+    def _search_result_from_hit(
+        self, hit: Hit, highlights: bool = True
+    ) -> Optional[SearchResult]:
+        """Return the search result for the given hit or None if the note no
+        longer exists."""
         matched_fields = self._get_matched_fields(hit.matched_terms())
 
         title = self._strip_ext(hit["filename"])
@@ -332,22 +742,29 @@ class FileSystemNotes(BaseNotes):
         # is a float.
         score = hit.score if type(hit.score) is float else None
 
-        if "title" in matched_fields:
-            hit.results.fragmenter = WholeFragmenter()
-            title_highlights = hit.highlights("title", text=title)
-        else:
-            title_highlights = None
-
-        if "content" in matched_fields:
-            hit.results.fragmenter = ContextFragmenter()
-            content = self._read_file(self._path_from_title(title))
-            content_ex_tags, _ = FileSystemNotes._extract_tags(content)
-            content_highlights = hit.highlights(
-                "content",
-                text=content_ex_tags,
-            )
-        else:
-            content_highlights = None
+        # Note: Highlighting (including reading the note to highlight its
+        # content) is also timed separately as it's usually the bulk of
+        # building a result.
+        with timing.measure("highlights"):
+            if highlights and "title" in matched_fields:
+                hit.results.fragmenter = WholeFragmenter()
+                title_highlights = hit.highlights("title", text=title)
+            else:
+                title_highlights = None
+
+            if highlights and "content" in matched_fields:
+                try:
+                    analysis = self._analyse_note(hit["filename"])
+                except FileNotFoundError:
+                    # The note has been deleted but the index hasn't caught
+                    # up yet
+                    return None
+                hit.results.fragmenter = ContextFragmenter()
+                content_highlights = hit.highlights(
+                    "content", text=analysis.content_ex_tags
+                )
+            else:
+                content_highlights = None
 
         tag_matches = (
             [field[1] for field in hit.matched_terms() if field[0] == "tags"]
@@ -380,15 +797,17 @@ class FileSystemNotes(BaseNotes):
         "tuples generated by whoosh.searching.Hit.matched_terms()."""
         return set([matched_term[0] for matched_term in matched_terms])
 
-    @staticmethod
-    def _read_file(filepath: str):
-        logger.debug(f"Reading from '{filepath}'")
-        with open(filepath, "r") as f:
-            content = f.read()
-        return content
 
-    @staticmethod
-    def _write_file(filepath: str, content: str, overwrite: bool = False):
-        logger.debug(f"Writing to '{filepath}'")
-        with open(filepath, "w" if overwrite else "x") as f:
-            f.write(content)
+def _load_document(filepath: str) -> dict:
+    """Read the note at the given filepath and return its index fields.
+    Note: This is a module level function so that it can be pickled for use
+    in a process pool."""
+    title = FileSystemNotes._strip_ext(os.path.basename(filepath))
+    note = Note(
+        title=title,
+        content=FileSystemNotes._read_file(filepath),
+        last_modified=os.path.getmtime(filepath),
+    )
+    return FileSystemNotes._document_from_note(
+        note, analyse_note(note.content)
+    )
@@ -0,0 +1,103 @@
+import atexit
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Optional, Tuple
+
+from whoosh.index import Index
+
+from logger import logger
+
+from .index_writer import IndexWriterThread
+
+
+class IndexMaintenanceThread:
+    """Periodically check the index in a background thread and queue an
+    optimization (a merge of all segments, which also purges deleted
+    documents) when:
+
+    - The number of segments exceeds `max_segments` or the proportion of
+      deleted documents exceeds `max_deleted_ratio`.
+    - The index hasn't been used for at least `idle_seconds`.
+    - The current (local) hour is within `hours`, if given. `hours` is a
+      (start, end) tuple that can wrap past midnight e.g. (22, 6)."""
+
+    CHECK_INTERVAL = 60
+
+    def __init__(
+        self,
+        get_index: Callable[[], Index],
+        index_writer: IndexWriterThread,
+        max_segments: int = 10,
+        max_deleted_ratio: float = 0.2,
+        idle_seconds: int = 60,
+        hours: Optional[Tuple[int, int]] = None,
+    ):
+        self._get_index = get_index
+        self._index_writer = index_writer
+        self.max_segments = max_segments
+        self.max_deleted_ratio = max_deleted_ratio
+        self.idle_seconds = idle_seconds
+        self.hours = hours
+        self._last_read_time = time.monotonic()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="flatnotes-index-maintenance", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+    def touch(self) -> None:
+        """Record that the index has been read."""
+        self._last_read_time = time.monotonic()
+
+    def is_idle(self) -> bool:
+        last_used = max(
+            self._last_read_time, self._index_writer.last_submit_time
+        )
+        return time.monotonic() - last_used >= self.idle_seconds
+
+    def in_hours(self, now: Optional[datetime] = None) -> bool:
+        if self.hours is None:
+            return True
+        hour = (now or datetime.now()).hour
+        start, end = self.hours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def needs_optimizing(self) -> bool:
+        index = self._get_index()
+        segment_count = len(index._segments())
+        doc_count_all = index.doc_count_all()
+        deleted_ratio = (
+            1 - index.doc_count() / doc_count_all if doc_count_all else 0
+        )
+        logger.debug(
+            f"Index has {segment_count} segments and "
+            + f"{deleted_ratio:.0%} deleted documents"
+        )
+        return (
+            segment_count > self.max_segments
+            or deleted_ratio > self.max_deleted_ratio
+        )
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.CHECK_INTERVAL):
+            try:
+                if (
+                    self.in_hours()
+                    and self.is_idle()
+                    and self.needs_optimizing()
+                ):
+                    logger.info("Scheduling index optimization")
+                    self._index_writer.submit_optimize()
+            except Exception as e:
+                logger.error(f"Failed to check index: {e}")
@@ -0,0 +1,196 @@
+import atexit
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from whoosh.index import LockError
+
+import metrics
+from logger import logger
+
+from ..models import Note
+
+
+class IndexWriterThread:
+    """Apply changes to the search index from a single background thread.
+
+    Changes are queued by note filename, with a later change to a note
+    replacing any earlier change that hasn't been applied yet. Queued changes
+    are applied together in a single commit once the oldest of them has
+    waited for `delay` seconds, or straight away if a flush is requested.
+
+    A queued change is either the Note to be indexed or None if the note
+    should be re-read from the notes directory (or removed from the index if
+    it no longer exists). A full sync can also be requested in which case
+    all queued changes are superseded by a scan of the whole directory, as
+    can an optimization of the index which is run after any other changes.
+
+    If the index is locked (e.g. by another process) the changes are kept
+    and retried, so callers never have to wait for the lock."""
+
+    def __init__(
+        self,
+        apply_changes: Callable[[Dict[str, Optional[Note]]], None],
+        apply_full_sync: Callable[[], None],
+        apply_optimize: Callable[[], None],
+        delay: float = 0.25,
+        retry_delay: float = 0.25,
+    ):
+        self._apply_changes = apply_changes
+        self._apply_full_sync = apply_full_sync
+        self._apply_optimize = apply_optimize
+        self.delay = delay
+        self.retry_delay = retry_delay
+        self._changes: Dict[str, Optional[Note]] = {}
+        self._full_sync_required = False
+        self._optimize_requested = False
+        self._oldest_change_time: Optional[float] = None
+        self.last_submit_time = time.monotonic()
+        # Each submission is numbered so that a flush can wait for exactly
+        # the changes submitted before it
+        self._submitted = 0
+        self._applied = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="flatnotes-index-writer", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout: float = 5) -> None:
+        """Apply any queued changes and stop the thread."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout=timeout)
+
+    def submit(self, changes: Dict[str, Optional[Note]]) -> None:
+        """Queue the given changes, keyed by note filename."""
+        if not changes:
+            return
+        with self._condition:
+            self._changes.update(changes)
+            self._queued()
+
+    def submit_full_sync(self) -> None:
+        """Queue a scan of the whole notes directory."""
+        with self._condition:
+            self._full_sync_required = True
+            self._queued()
+
+    def submit_optimize(self) -> None:
+        """Queue an optimization of the index. Note: Unlike other changes,
+        flushes don't wait for the optimization to finish."""
+        with self._condition:
+            self._optimize_requested = True
+            self._start_delay()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Apply all changes queued so far without waiting for the rest of
+        the delay. Returns False if they still hadn't been applied after
+        `timeout` seconds."""
+        with self._condition:
+            target = self._submitted
+            if self._applied >= target:
+                return True
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(
+                lambda: self._applied >= target, timeout
+            )
+
+    def _queued(self) -> None:
+        self._submitted += 1
+        self.last_submit_time = time.monotonic()
+        self._start_delay()
+
+    def _start_delay(self) -> None:
+        if self._oldest_change_time is None:
+            self._oldest_change_time = time.monotonic()
+        self._condition.notify_all()
+
+    def _has_changes(self) -> bool:
+        return (
+            self._full_sync_required
+            or self._optimize_requested
+            or bool(self._changes)
+        )
+
+    def _take_changes(self):
+        """Wait for queued changes to become due and return them along with
+        the number of the last submission they include. Returns None if the
+        thread should stop."""
+        with self._condition:
+            while not self._has_changes():
+                if self._stopping:
+                    return None
+                self._condition.wait()
+            while not (self._flush_requested or self._stopping):
+                remaining = (
+                    self._oldest_change_time + self.delay - time.monotonic()
+                )
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            changes = self._changes
+            full_sync = self._full_sync_required
+            optimize = self._optimize_requested
+            submitted = self._submitted
+            self._changes = {}
+            self._full_sync_required = False
+            self._optimize_requested = False
+            self._oldest_change_time = None
+            self._flush_requested = False
+        return changes, full_sync, optimize, submitted
+
+    def _requeue(
+        self,
+        changes: Dict[str, Optional[Note]],
+        full_sync: bool,
+        optimize: bool,
+    ) -> None:
+        """Put changes that couldn't be applied back in the queue, behind
+        any changes to the same notes made since."""
+        with self._condition:
+            changes.update(self._changes)
+            self._changes = changes
+            self._full_sync_required |= full_sync
+            self._optimize_requested |= optimize
+            self._oldest_change_time = time.monotonic()
+
+    def _run(self) -> None:
+        while True:
+            taken = self._take_changes()
+            if taken is None:
+                return
+            changes, full_sync, optimize, submitted = taken
+            try:
+                if full_sync:
+                    self._apply_full_sync()
+                elif changes:
+                    self._apply_changes(changes)
+                changes, full_sync = {}, False
+                self._mark_applied(submitted)
+                if optimize:
+                    self._apply_optimize()
+            except LockError:
+                metrics.index_lock_retries.inc(operation="write")
+                logger.warning(
+                    f"Index locked, retrying in {self.retry_delay}s"
+                )
+                self._requeue(changes, full_sync, optimize)
+                time.sleep(self.retry_delay)
+            except Exception as e:
+                # Give up on the changes rather than retrying them forever
+                logger.error(f"Failed to update index: {e}")
+                self._mark_applied(submitted)
+
+    def _mark_applied(self, submitted: int) -> None:
+        with self._condition:
+            self._applied = max(self._applied, submitted)
+            self._condition.notify_all()
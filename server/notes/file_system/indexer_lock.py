@@ -0,0 +1,41 @@
+import os
+from typing import Optional, TextIO
+
+try:
+    import fcntl
+except ImportError:  # e.g. Windows
+    fcntl = None
+
+
+class IndexerLock:
+    """An exclusive, non-blocking lock on a file used to elect the one
+    process that maintains the index when running multiple workers. The
+    lock is held until the process exits, at which point the operating
+    system releases it so that another process can take over.
+
+    If file locking isn't supported, the lock is always acquired."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file: Optional[TextIO] = None
+
+    @property
+    def is_held(self) -> bool:
+        return self._file is not None or fcntl is None
+
+    def acquire(self) -> bool:
+        """Try to acquire the lock without waiting. Returns True if the lock
+        is held by this process."""
+        if self.is_held:
+            return True
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        file.truncate(0)
+        file.write(str(os.getpid()))
+        file.flush()
+        self._file = file
+        return True
@@ -0,0 +1,650 @@
+import glob
+import os
+import re
+import sys
+import time
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+)
+
+import aiofiles
+import aiofiles.os
+from whoosh.index import LockError
+
+import metrics
+import timing
+from helpers import (
+    LRUCache,
+    get_env,
+    is_valid_filename,
+    iterate_in_executor,
+    run_in_executor,
+)
+from logger import logger
+from request_profiling import profiled, profiled_iterator
+
+from ..analysis import NoteAnalysis, analyse_note
+from ..base import BaseNotes
+from ..models import Note, NoteCreate, NoteUpdate, SearchResult
+from .index_writer import IndexWriterThread
+from .watcher import NoteWatcher
+
+MARKDOWN_EXT = ".md"
+
+
+class MarkdownNotes(BaseNotes):
+    """Notes stored as markdown files in the FLATNOTES_PATH directory.
+
+    Subclasses provide the search index. Changes to the notes are written to
+    it by an index writer thread, fed by this class and by a watcher of the
+    notes directory. Writes that fail with a LockError are retried, whatever
+    the index."""
+
+    TAGS_WITH_HASH_RE = re.compile(
+        r"(?:(?<=^)|(?<=\s))#[a-zA-Z0-9_-]+(?=\s|$)"
+    )
+
+    # The maximum number of seconds a search will wait for queued changes to
+    # be committed before searching the index as it is
+    INDEX_FLUSH_TIMEOUT = 2
+
+    def __init__(self):
+        self.storage_path = get_env("FLATNOTES_PATH", mandatory=True)
+        if not os.path.exists(self.storage_path):
+            raise NotADirectoryError(
+                f"'{self.storage_path}' is not a valid directory."
+            )
+        self._analysis_cache = self._load_analysis_cache()
+        # Search results keyed by (generation, term, sort, order, limit). The
+        # cache is cleared whenever the index generation changes. It is
+        # bounded by the total number of results (plus one per search so
+        # that searches without results are bounded too) as a single search
+        # can return every note.
+        self._search_cache = LRUCache(
+            get_env(
+                "FLATNOTES_SEARCH_CACHE_RESULTS",
+                mandatory=False,
+                default=10000,
+                cast_int=True,
+            ),
+            sizeof=lambda results: len(results) + 1,
+        )
+        self._search_cache_generation = None
+        self._executor = self._load_search_executor()
+        self._index_writer = None
+        self._watcher = None
+
+    def create(self, data: NoteCreate) -> Note:
+        """Create a new note."""
+        filepath = self._path_from_title(data.title)
+        self._write_file(filepath, data.content)
+        note = Note(
+            title=data.title,
+            content=data.content,
+            last_modified=os.path.getmtime(filepath),
+        )
+        self._queue_index_changes({note.title + MARKDOWN_EXT: note})
+        return note
+
+    def get(self, title: str) -> Note:
+        """Get a specific note."""
+        is_valid_filename(title)
+        filepath = self._path_from_title(title)
+        content = self._read_file(filepath)
+        return Note(
+            title=title,
+            content=content,
+            last_modified=os.path.getmtime(filepath),
+        )
+
+    def get_etag(self, title: str) -> str:
+        """Get an entity tag for the current version of a specific note
+        without reading it."""
+        is_valid_filename(title)
+        return self._etag_from_stat(os.stat(self._path_from_title(title)))
+
+    def update(self, title: str, data: NoteUpdate) -> Note:
+        """Update a specific note."""
+        is_valid_filename(title)
+        filepath = self._path_from_title(title)
+        changes = {}
+        if data.new_title is not None:
+            new_filepath = self._path_from_title(data.new_title)
+            if filepath != new_filepath and os.path.isfile(new_filepath):
+                raise FileExistsError(
+                    f"Failed to rename. '{data.new_title}' already exists."
+                )
+            os.rename(filepath, new_filepath)
+            if filepath != new_filepath:
+                changes[title + MARKDOWN_EXT] = None
+            title = data.new_title
+            filepath = new_filepath
+        if data.new_content is not None:
+            self._write_file(filepath, data.new_content, overwrite=True)
+            content = data.new_content
+        else:
+            content = self._read_file(filepath)
+        note = Note(
+            title=title,
+            content=content,
+            last_modified=os.path.getmtime(filepath),
+        )
+        changes[note.title + MARKDOWN_EXT] = note
+        self._queue_index_changes(changes)
+        return note
+
+    def delete(self, title: str) -> None:
+        """Delete a specific note."""
+        is_valid_filename(title)
+        filepath = self._path_from_title(title)
+        os.remove(filepath)
+        self._queue_index_changes({title + MARKDOWN_EXT: None})
+
+    async def create_async(self, data: NoteCreate) -> Note:
+        """Create a new note."""
+        filepath = self._path_from_title(data.title)
+        await self._write_file_async(filepath, data.content)
+        note = Note(
+            title=data.title,
+            content=data.content,
+            last_modified=await aiofiles.os.path.getmtime(filepath),
+        )
+        self._queue_index_changes({note.title + MARKDOWN_EXT: note})
+        return note
+
+    async def get_async(self, title: str) -> Note:
+        """Get a specific note."""
+        is_valid_filename(title)
+        filepath = self._path_from_title(title)
+        content = await self._read_file_async(filepath)
+        return Note(
+            title=title,
+            content=content,
+            last_modified=await aiofiles.os.path.getmtime(filepath),
+        )
+
+    async def get_etag_async(self, title: str) -> str:
+        """Get an entity tag for the current version of a specific note
+        without reading it."""
+        is_valid_filename(title)
+        return self._etag_from_stat(
+            await aiofiles.os.stat(self._path_from_title(title))
+        )
+
+    async def update_async(self, title: str, data: NoteUpdate) -> Note:
+        """Update a specific note."""
+        is_valid_filename(title)
+        filepath = self._path_from_title(title)
+        changes = {}
+        if data.new_title is not None:
+            new_filepath = self._path_from_title(data.new_title)
+            if filepath != new_filepath and await aiofiles.os.path.isfile(
+                new_filepath
+            ):
+                raise FileExistsError(
+                    f"Failed to rename. '{data.new_title}' already exists."
+                )
+            await aiofiles.os.rename(filepath, new_filepath)
+            if filepath != new_filepath:
+                changes[title + MARKDOWN_EXT] = None
+            title = data.new_title
+            filepath = new_filepath
+        if data.new_content is not None:
+            await self._write_file_async(
+                filepath, data.new_content, overwrite=True
+            )
+            content = data.new_content
+        else:
+            content = await self._read_file_async(filepath)
+        note = Note(
+            title=title,
+            content=content,
+            last_modified=await aiofiles.os.path.getmtime(filepath),
+        )
+        changes[note.title + MARKDOWN_EXT] = note
+        self._queue_index_changes(changes)
+        return note
+
+    async def delete_async(self, title: str) -> None:
+        """Delete a specific note."""
+        is_valid_filename(title)
+        filepath = self._path_from_title(title)
+        await aiofiles.os.remove(filepath)
+        self._queue_index_changes({title + MARKDOWN_EXT: None})
+
+    def search(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> Tuple[SearchResult, ...]:
+        """Search the index for the given term."""
+        return tuple(
+            self.iter_search(
+                term,
+                sort=sort,
+                order=order,
+                limit=limit,
+                offset=offset,
+                highlights=highlights,
+            )
+        )
+
+    def iter_search(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> Iterator[SearchResult]:
+        """Search the index for the given term, yielding each result as soon
+        as it is ready."""
+        with self._search_phase("sync"):
+            self._refresh_index()
+        # Note: The generation is included in the key so that results from a
+        # search that straddles a commit are never returned as current.
+        generation = self._index_generation()
+        cache_key = (generation, term, sort, order, limit, offset, highlights)
+        if generation != self._search_cache_generation:
+            self._search_cache.clear()
+            self._search_cache_generation = generation
+        results = self._search_cache.get(cache_key)
+        metrics.search_cache_requests.inc(
+            result="miss" if results is None else "hit"
+        )
+        timing.describe("cache", "miss" if results is None else "hit")
+        logger.debug(
+            f"Search cache {'miss' if results is None else 'hit'} "
+            + f"(hits: {self._search_cache.hits}, "
+            + f"misses: {self._search_cache.misses})"
+        )
+        if results is not None:
+            yield from results
+            return
+        # Note: Results are only collected while they could still fit in the
+        # cache
+        results = []
+        for result in self._iter_search(
+            term,
+            sort=sort,
+            order=order,
+            limit=limit,
+            offset=offset,
+            highlights=highlights,
+        ):
+            if results is not None:
+                results.append(result)
+                if len(results) >= self._search_cache.max_size:
+                    results = None
+            yield result
+        if results is not None:
+            self._search_cache.set(cache_key, tuple(results))
+
+    async def search_async(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> Tuple[SearchResult, ...]:
+        """Search the index for the given term."""
+        return await run_in_executor(
+            self._executor,
+            profiled(self.search),
+            term,
+            sort=sort,
+            order=order,
+            limit=limit,
+            offset=offset,
+            highlights=highlights,
+        )
+
+    def iter_search_async(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> AsyncIterator[SearchResult]:
+        """Search the index for the given term, yielding each result as soon
+        as it is ready."""
+        return iterate_in_executor(
+            self._executor,
+            profiled_iterator(
+                self.iter_search(
+                    term,
+                    sort=sort,
+                    order=order,
+                    limit=limit,
+                    offset=offset,
+                    highlights=highlights,
+                )
+            ),
+        )
+
+    async def get_highlights_async(
+        self, term: str, titles: List[str]
+    ) -> Tuple[SearchResult, ...]:
+        """Return the search results, including highlights, for the given
+        term limited to the given note titles."""
+        return await run_in_executor(
+            self._executor, profiled(self.get_highlights), term, titles
+        )
+
+    async def get_tags_async(self) -> list[str]:
+        """Return a list of all tags in use."""
+        return await run_in_executor(self._executor, profiled(self.get_tags))
+
+    async def get_tag_counts_async(self) -> dict[str, int]:
+        """Return the number of notes using each tag."""
+        return await run_in_executor(
+            self._executor, profiled(self.get_tag_counts)
+        )
+
+    @abstractmethod
+    def _iter_search(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+    ) -> Iterator[SearchResult]:
+        """Search the index for the given term, bypassing the cache."""
+        pass
+
+    @abstractmethod
+    def _index_generation(self) -> int:
+        """Return a number that changes whenever the index is changed, by
+        any process."""
+        pass
+
+    @abstractmethod
+    def _queue_index_changes(self, changes: Dict[str, Optional[Note]]):
+        """Queue changes made by this process, keyed by filename, to be
+        written to the index. A change is either the Note to be indexed or
+        None if the note was removed."""
+        pass
+
+    @abstractmethod
+    def _refresh_index(self) -> None:
+        """Bring the index up to date before it is read."""
+        pass
+
+    @abstractmethod
+    def _sync_index(self, optimize: bool = False, clean: bool = False) -> None:
+        """Synchronize the index with the notes directory.
+        Specify clean=True to completely rebuild the index."""
+        pass
+
+    @abstractmethod
+    def _sync_index_changes(self, changes: Dict[str, Optional[Note]]) -> None:
+        """Apply the given changes, keyed by note filename, to the index in a
+        single commit. A change is either the Note to be indexed or None if
+        the note should be synchronized with the notes directory."""
+        pass
+
+    @abstractmethod
+    def _optimize_index(self) -> None:
+        """Optimize the index for searching."""
+        pass
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.storage_path, ".flatnotes")
+
+    @staticmethod
+    @contextmanager
+    def _search_phase(name: str) -> Iterator[None]:
+        """Record the time taken by the body of a with statement as the
+        named search phase, in both the metrics and the request's
+        Server-Timing header."""
+        with metrics.search_phase_duration.time(phase=name):
+            with timing.measure(name):
+                yield
+
+    def _path_from_title(self, title: str) -> str:
+        return os.path.join(self.storage_path, title + MARKDOWN_EXT)
+
+    def _get_by_filename(self, filename: str) -> Note:
+        """Get a note by its filename."""
+        return self.get(self._strip_ext(filename))
+
+    def _read_note(self, filename: str) -> Tuple[Note, os.stat_result]:
+        """Read a note by its filename for indexing. The note is returned
+        along with the stat taken before it was read, which is also used for
+        its modification time, so that if the note changes while it's being
+        read the change is picked up by the next sync."""
+        filepath = os.path.join(self.storage_path, filename)
+        stat = os.stat(filepath)
+        note = Note(
+            title=self._strip_ext(filename),
+            content=self._read_file(filepath),
+            last_modified=stat.st_mtime,
+        )
+        return note, stat
+
+    @staticmethod
+    def _load_analysis_cache() -> LRUCache:
+        """Create the cache of note analyses used for indexing and
+        highlighting, keyed by (filename, mtime, size) and bounded by the
+        size of the content."""
+        return LRUCache(
+            get_env(
+                "FLATNOTES_ANALYSIS_CACHE_MB",
+                mandatory=False,
+                default=32,
+                cast_int=True,
+            )
+            * 1024
+            * 1024,
+            sizeof=lambda analysis: len(analysis.content_ex_tags),
+        )
+
+    @staticmethod
+    def _load_search_executor() -> ThreadPoolExecutor:
+        """Create a dedicated pool for searches so that expensive searches
+        can't starve the threads used by other requests."""
+        return ThreadPoolExecutor(
+            max_workers=get_env(
+                "FLATNOTES_SEARCH_THREADS",
+                mandatory=False,
+                default=4,
+                cast_int=True,
+            ),
+            thread_name_prefix="flatnotes-search",
+        )
+
+    def _load_index_writer(self) -> IndexWriterThread:
+        """Create the thread that makes all changes to the index after the
+        initial sync, committing them in groups."""
+        return IndexWriterThread(
+            self._sync_index_changes,
+            self._sync_index,
+            self._optimize_index,
+            delay=get_env(
+                "FLATNOTES_INDEX_COMMIT_DELAY_MS",
+                mandatory=False,
+                default=250,
+                cast_int=True,
+            )
+            / 1000,
+        )
+
+    def _load_watcher(self) -> Optional[NoteWatcher]:
+        """Start a watcher for the notes directory as configured by
+        FLATNOTES_WATCH_MODE. Returns None if watching is disabled, in which
+        case the whole directory is scanned for changes on every search."""
+        key = "FLATNOTES_WATCH_MODE"
+        valid_values = ["native", "polling", "off"]
+        mode = get_env(key, mandatory=False, default="native").lower()
+        if mode not in valid_values:
+            logger.error(
+                f"Invalid value '{mode}' for {key}. "
+                + "Must be one of: "
+                + ", ".join(valid_values)
+                + "."
+            )
+            sys.exit(1)
+        if mode == "off":
+            return None
+        if not NoteWatcher.is_available():
+            logger.warning(
+                "File watching is unavailable as the 'watchfiles' package is "
+                + "not installed. The notes directory will be scanned for "
+                + "changes on every search."
+            )
+            return None
+        watcher = NoteWatcher(
+            self.storage_path,
+            MARKDOWN_EXT,
+            on_changes=lambda filenames: self._index_writer.submit(
+                dict.fromkeys(filenames)
+            ),
+            on_missed_changes=self._index_writer.submit_full_sync,
+            force_polling=mode == "polling",
+        )
+        watcher.start()
+        return watcher
+
+    def _analyse_note(
+        self,
+        filename: str,
+        content: Optional[str] = None,
+        stat: Optional[os.stat_result] = None,
+    ) -> NoteAnalysis:
+        """Return the analysis of the note with the given filename. The note
+        is only read and analysed if it has changed since it was last
+        analysed. Specify `content` if the note has already been read, along
+        with the `stat` taken before it was read. Without the stat, the
+        analysis isn't cached as the note may have changed since."""
+        if content is not None and stat is None:
+            return analyse_note(content)
+        filepath = os.path.join(self.storage_path, filename)
+        if stat is None:
+            stat = os.stat(filepath)
+        # Note: The note is always read after the stat so that, if it changes
+        # in between, the cached analysis is stored under an outdated key
+        # rather than being returned for the new version.
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        analysis = self._analysis_cache.get(key)
+        if analysis is None:
+            if content is None:
+                content = self._read_file(filepath)
+            analysis = analyse_note(content)
+            self._analysis_cache.set(key, analysis)
+        return analysis
+
+    def _list_all_note_filenames(self) -> List[str]:
+        """Return a list of all note filenames."""
+        return [
+            os.path.split(filepath)[1]
+            for filepath in glob.glob(
+                os.path.join(self.storage_path, "*" + MARKDOWN_EXT)
+            )
+        ]
+
+    def _sync_index_with_retry(
+        self,
+        optimize: bool = False,
+        clean: bool = False,
+        max_retries: int = 8,
+        retry_delay: float = 0.25,
+    ) -> bool:
+        """Synchronize the index, retrying if it is locked. Returns True if
+        the sync was successful."""
+        return self._with_retry(
+            lambda: self._sync_index(optimize=optimize, clean=clean),
+            "sync index",
+            max_retries=max_retries,
+            retry_delay=retry_delay,
+        )
+
+    @staticmethod
+    def _with_retry(
+        func,
+        description: str,
+        max_retries: int = 8,
+        retry_delay: float = 0.25,
+    ) -> bool:
+        """Call `func`, retrying if the index is locked. Returns True if the
+        call was successful."""
+        for _ in range(max_retries):
+            try:
+                func()
+                return True
+            except LockError:
+                metrics.index_lock_retries.inc(operation=description)
+                logger.warning(f"Index locked, retrying in {retry_delay}s")
+                time.sleep(retry_delay)
+        logger.error(f"Failed to {description} after {max_retries} retries")
+        return False
+
+    @classmethod
+    def _pre_process_search_term(cls, term):
+        term = term.strip()
+        # Replace "#tagname" with "tags:tagname"
+        term = re.sub(
+            cls.TAGS_WITH_HASH_RE,
+            lambda tag: "tags:" + tag.group(0)[1:],
+            term,
+        )
+        return term
+
+    @staticmethod
+    def _etag_from_stat(stat: os.stat_result) -> str:
+        """Return an entity tag derived from a note's modification time and
+        size."""
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    @staticmethod
+    def _strip_ext(filename):
+        """Return the given filename without the extension."""
+        return os.path.splitext(filename)[0]
+
+    @staticmethod
+    def _read_file(filepath: str):
+        logger.debug(f"Reading from '{filepath}'")
+        with open(filepath, "r") as f:
+            content = f.read()
+        return content
+
+    @staticmethod
+    def _write_file(filepath: str, content: str, overwrite: bool = False):
+        logger.debug(f"Writing to '{filepath}'")
+        with open(filepath, "w" if overwrite else "x") as f:
+            f.write(content)
+
+    @staticmethod
+    async def _read_file_async(filepath: str):
+        logger.debug(f"Reading from '{filepath}'")
+        async with aiofiles.open(filepath, "r") as f:
+            content = await f.read()
+        return content
+
+    @staticmethod
+    async def _write_file_async(
+        filepath: str, content: str, overwrite: bool = False
+    ):
+        logger.debug(f"Writing to '{filepath}'")
+        async with aiofiles.open(filepath, "w" if overwrite else "x") as f:
+            await f.write(content)
@@ -0,0 +1,69 @@
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+from whoosh.index import Index
+from whoosh.searching import Searcher
+
+
+class SearcherManager:
+    """Share a single long-lived searcher between requests so that segment
+    metadata and per-searcher caches (e.g. the columns used for sorting)
+    aren't reloaded for every search.
+
+    The searcher is only reopened when the index generation changes.
+    Searchers are reference counted so that requests using a searcher when
+    it is replaced keep a consistent view of the index, with the replaced
+    searcher being closed once the last of them has finished with it."""
+
+    def __init__(self, get_index: Callable[[], Index]):
+        self._get_index = get_index
+        self._searcher: Optional[Searcher] = None
+        self._generation: Optional[int] = None
+        self._ref_counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def searcher(self) -> Iterator[Searcher]:
+        """Return the current searcher for use in a with statement."""
+        searcher = self.acquire()
+        try:
+            yield searcher
+        finally:
+            self.release(searcher)
+
+    def acquire(self) -> Searcher:
+        """Return the current searcher, opening a new one if the index has
+        changed. Every call must be matched by a call to `release()`."""
+        index = self._get_index()
+        generation = index.latest_generation()
+        with self._lock:
+            if self._searcher is None or self._generation != generation:
+                previous = self._searcher
+                self._searcher = index.searcher()
+                self._generation = generation
+                # The manager holds a reference to the current searcher
+                self._ref_counts[id(self._searcher)] = 1
+                if previous is not None:
+                    self._release(previous)
+            self._ref_counts[id(self._searcher)] += 1
+            return self._searcher
+
+    def release(self, searcher: Searcher) -> None:
+        with self._lock:
+            self._release(searcher)
+
+    def close(self) -> None:
+        """Close the current searcher once it is no longer in use."""
+        with self._lock:
+            if self._searcher is not None:
+                self._release(self._searcher)
+                self._searcher = None
+                self._generation = None
+
+    def _release(self, searcher: Searcher) -> None:
+        key = id(searcher)
+        self._ref_counts[key] -= 1
+        if self._ref_counts[key] == 0:
+            del self._ref_counts[key]
+            searcher.close()
@@ -0,0 +1,69 @@
+import threading
+from typing import Dict, Iterable, List, Set
+
+
+class TagIndex:
+    """An in-memory map of tags to the filenames of the notes that use them,
+    kept up to date alongside the search index so that tags can be listed
+    and counted without reading the search index."""
+
+    def __init__(self):
+        self._filenames_by_tag: Dict[str, Set[str]] = {}
+        self._tags_by_filename: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def set(self, filename: str, tags: Iterable[str]) -> None:
+        """Set the tags used by the given note."""
+        tags = set(tags)
+        with self._lock:
+            self._remove(filename)
+            if not tags:
+                return
+            self._tags_by_filename[filename] = tags
+            for tag in tags:
+                self._filenames_by_tag.setdefault(tag, set()).add(filename)
+
+    def remove(self, filename: str) -> None:
+        """Remove the given note."""
+        with self._lock:
+            self._remove(filename)
+
+    def replace(self, tags_by_filename: Dict[str, Iterable[str]]) -> None:
+        """Replace the whole index with the given tags for each note."""
+        filenames_by_tag = {}
+        tags_by_filename = {
+            filename: set(tags)
+            for filename, tags in tags_by_filename.items()
+            if tags
+        }
+        for filename, tags in tags_by_filename.items():
+            for tag in tags:
+                filenames_by_tag.setdefault(tag, set()).add(filename)
+        with self._lock:
+            self._filenames_by_tag = filenames_by_tag
+            self._tags_by_filename = tags_by_filename
+
+    def clear(self) -> None:
+        with self._lock:
+            self._filenames_by_tag.clear()
+            self._tags_by_filename.clear()
+
+    def tags(self) -> List[str]:
+        """Return a sorted list of all tags in use."""
+        with self._lock:
+            return sorted(self._filenames_by_tag)
+
+    def counts(self) -> Dict[str, int]:
+        """Return the number of notes using each tag, sorted by tag."""
+        with self._lock:
+            return {
+                tag: len(self._filenames_by_tag[tag])
+                for tag in sorted(self._filenames_by_tag)
+            }
+
+    def _remove(self, filename: str) -> None:
+        for tag in self._tags_by_filename.pop(filename, ()):
+            filenames = self._filenames_by_tag[tag]
+            filenames.discard(filename)
+            if not filenames:
+                del self._filenames_by_tag[tag]
@@ -0,0 +1,89 @@
+import atexit
+import os
+import threading
+from typing import Callable, Set
+
+from logger import logger
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+
+class NoteWatcher:
+    """Watch a directory in a background thread and report the note
+    filenames that have been added, modified or removed to `on_changes`.
+    `on_missed_changes` is called if changes may have been missed e.g. while
+    switching to polling.
+
+    Native file system events (e.g. inotify) are used where available with a
+    fallback to polling if they can't be used (e.g. some network shares)."""
+
+    def __init__(
+        self,
+        path: str,
+        ext: str,
+        on_changes: Callable[[Set[str]], None],
+        on_missed_changes: Callable[[], None],
+        force_polling: bool = False,
+    ):
+        self.path = path
+        self.ext = ext
+        self.force_polling = force_polling
+        self._on_changes = on_changes
+        self._on_missed_changes = on_missed_changes
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="flatnotes-watcher", daemon=True
+        )
+
+    @staticmethod
+    def is_available() -> bool:
+        return watchfiles is not None
+
+    @property
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def start(self) -> None:
+        self._thread.start()
+        # Note: The watcher must be stopped before the interpreter shuts down
+        # as the underlying watcher thread can't be killed safely.
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+    def _watch_filter(self, _, path: str) -> bool:
+        return path.endswith(self.ext)
+
+    def _run(self) -> None:
+        force_polling = self.force_polling
+        while not self._stop_event.is_set():
+            mode = "polling" if force_polling else "native events"
+            logger.info(f"Watching '{self.path}' for changes ({mode})")
+            try:
+                for changes in watchfiles.watch(
+                    self.path,
+                    watch_filter=self._watch_filter,
+                    stop_event=self._stop_event,
+                    force_polling=force_polling,
+                    recursive=False,
+                    raise_interrupt=False,
+                ):
+                    self._on_changes(
+                        {os.path.basename(path) for _, path in changes}
+                    )
+            except Exception as e:
+                self._on_missed_changes()
+                if force_polling:
+                    logger.error(f"File watcher stopped: {e}")
+                    return
+                logger.warning(
+                    f"Native file watching failed ({e}), "
+                    + "falling back to polling"
+                )
+                force_polling = True
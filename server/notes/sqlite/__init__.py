@@ -0,0 +1 @@
+from .sqlite import SQLiteNotes
@@ -0,0 +1,242 @@
+"""Translate search terms into SQLite queries.
+
+The supported syntax is the subset of the Whoosh query language used with
+flatnotes: words (implicitly ANDed), "quoted phrases", AND, OR, NOT,
+parentheses, trailing wildcards (e.g. "proj*") and the title:, content: and
+tags: fields. "#tag" is converted to "tags:tag" before parsing (see
+MarkdownNotes._pre_process_search_term).
+
+Words and phrases are matched using the FTS5 table while tags are matched
+exactly using the tags table, so a query is compiled to both an FTS5 MATCH
+expression (where possible) and an SQL condition."""
+
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple, Union
+
+# Note: Phrases are searched in the title and content but not the tags
+WORD_COLUMNS = "{title content tags}"
+PHRASE_COLUMNS = "{title content}"
+FIELDS = ("title", "content", "tags")
+OPERATORS = ("AND", "OR", "NOT")
+TOKEN_RE = re.compile(r'(?:\w+:)?"[^"]*"?|[()]|[^\s()]+')
+
+
+@dataclass
+class Text:
+    """A word or phrase matched using the FTS5 table."""
+
+    text: str
+    columns: str
+    prefix: bool = False
+
+    def fts(self) -> str:
+        escaped = self.text.replace('"', '""')
+        return f'{self.columns} : "{escaped}"' + ("*" if self.prefix else "")
+
+
+@dataclass
+class Tag:
+    tag: str
+    prefix: bool = False
+
+    def matches(self, tag: str) -> bool:
+        return tag.startswith(self.tag) if self.prefix else tag == self.tag
+
+
+@dataclass
+class And:
+    children: List["Node"] = field(default_factory=list)
+
+
+@dataclass
+class Or:
+    children: List["Node"] = field(default_factory=list)
+
+
+@dataclass
+class Not:
+    child: "Node"
+
+
+Node = Union[Text, Tag, And, Or, Not]
+
+
+class Parser:
+    def __init__(self, term: str):
+        self._tokens = TOKEN_RE.findall(term)
+        self._position = 0
+
+    def parse(self) -> Optional[Node]:
+        node = self._parse_or()
+        # Ignore any unbalanced closing parentheses
+        while self._peek() is not None:
+            self._position += 1
+            node = _combine(And, [node, self._parse_or()])
+        return node
+
+    def _peek(self) -> Optional[str]:
+        if self._position < len(self._tokens):
+            return self._tokens[self._position]
+        return None
+
+    def _next(self) -> str:
+        token = self._tokens[self._position]
+        self._position += 1
+        return token
+
+    def _parse_or(self) -> Optional[Node]:
+        children = [self._parse_and()]
+        while self._peek() == "OR":
+            self._next()
+            children.append(self._parse_and())
+        return _combine(Or, children)
+
+    def _parse_and(self) -> Optional[Node]:
+        children = []
+        while self._peek() not in (None, ")", "OR"):
+            if self._peek() == "AND":
+                self._next()
+                continue
+            children.append(self._parse_not())
+        return _combine(And, children)
+
+    def _parse_not(self) -> Optional[Node]:
+        if self._peek() == "NOT":
+            self._next()
+            if self._peek() in (None, ")", "OR"):
+                return None
+            child = self._parse_not()
+            return None if child is None else Not(child)
+        return self._parse_atom()
+
+    def _parse_atom(self) -> Optional[Node]:
+        token = self._next()
+        if token == "(":
+            node = self._parse_or()
+            if self._peek() == ")":
+                self._next()
+            return node
+        return _parse_term(token)
+
+
+def _parse_term(token: str) -> Optional[Node]:
+    fieldname, _, value = token.partition(":")
+    if fieldname not in FIELDS or not value:
+        fieldname, value = None, token
+    if fieldname == "tags":
+        tag = value.strip('"').lower()
+        prefix = tag.endswith("*")
+        tag = tag.rstrip("*")
+        return Tag(tag, prefix=prefix) if tag else None
+    if value.startswith('"'):
+        phrase = value.strip('"')
+        if not phrase.strip():
+            return None
+        return Text(phrase, fieldname or PHRASE_COLUMNS)
+    prefix = value.endswith("*")
+    # Note: FTS5 only supports wildcards at the end of a word
+    value = value.replace("*", " ").replace("?", " ").strip()
+    if not value:
+        return None
+    return Text(value, fieldname or WORD_COLUMNS, prefix=prefix)
+
+
+def _combine(kind, children: List[Optional[Node]]) -> Optional[Node]:
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return kind(children)
+
+
+def parse(term: str) -> Optional[Node]:
+    """Parse a search term. Returns None if there is nothing to search for
+    e.g. the term only includes operators."""
+    return Parser(term).parse()
+
+
+def to_fts(node: Node) -> Optional[str]:
+    """Return an FTS5 MATCH expression equivalent to the given query, or
+    None if it can't be expressed as one (i.e. it includes tags or a NOT
+    without anything to exclude it from)."""
+    if isinstance(node, Text):
+        return node.fts()
+    if isinstance(node, Or):
+        children = [to_fts(child) for child in node.children]
+        if None in children:
+            return None
+        return "(" + " OR ".join(children) + ")"
+    if isinstance(node, And):
+        positive = [c for c in node.children if not isinstance(c, Not)]
+        negative = [c.child for c in node.children if isinstance(c, Not)]
+        if not positive:
+            return None
+        expressions = [to_fts(child) for child in positive]
+        excluded = [to_fts(child) for child in negative]
+        if None in expressions or None in excluded:
+            return None
+        expression = "(" + " AND ".join(expressions) + ")"
+        for exclude in excluded:
+            expression += f" NOT {exclude}"
+        return "(" + expression + ")"
+    return None
+
+
+def to_sql(node: Node, id_column: str) -> Tuple[str, list]:
+    """Return an SQL condition, and its parameters, that is true for the
+    note ids (in `id_column`) that match the given query."""
+    fts = to_fts(node)
+    if fts is not None:
+        return (
+            f"{id_column} IN "
+            + "(SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?)",
+            [fts],
+        )
+    if isinstance(node, Tag):
+        if node.prefix:
+            return (
+                f"{id_column} IN (SELECT note_id FROM note_tags "
+                + "WHERE substr(tag, 1, ?) = ?)",
+                [len(node.tag), node.tag],
+            )
+        return (
+            f"{id_column} IN (SELECT note_id FROM note_tags WHERE tag = ?)",
+            [node.tag],
+        )
+    if isinstance(node, Not):
+        condition, params = to_sql(node.child, id_column)
+        return f"NOT ({condition})", params
+    operator = " AND " if isinstance(node, And) else " OR "
+    conditions = []
+    params = []
+    for child in node.children:
+        condition, child_params = to_sql(child, id_column)
+        conditions.append(f"({condition})")
+        params.extend(child_params)
+    return operator.join(conditions), params
+
+
+def positive_terms(
+    node: Optional[Node], negated: bool = False
+) -> Tuple[List[Text], List[Tag]]:
+    """Return the words/phrases and tags in the query that aren't negated
+    i.e. those that can be highlighted in the results."""
+    texts, tags = [], []
+    if node is None:
+        return texts, tags
+    if isinstance(node, Text):
+        if not negated:
+            texts.append(node)
+    elif isinstance(node, Tag):
+        if not negated:
+            tags.append(node)
+    elif isinstance(node, Not):
+        return positive_terms(node.child, not negated)
+    else:
+        for child in node.children:
+            child_texts, child_tags = positive_terms(child, negated)
+            texts.extend(child_texts)
+            tags.extend(child_tags)
+    return texts, tags
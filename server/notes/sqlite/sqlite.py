@@ -0,0 +1,556 @@
+import html
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Literal, Optional, Tuple
+
+from whoosh.index import LockError
+
+import metrics
+import timing
+from logger import logger
+
+from ..file_system.markdown_notes import MARKDOWN_EXT, MarkdownNotes
+from ..models import Note, SearchResult
+from .query import (
+    WORD_COLUMNS,
+    Node,
+    Tag,
+    parse,
+    positive_terms,
+    to_fts,
+    to_sql,
+)
+
+SCHEMA_VERSION = "1"
+DATABASE_PREFIX = "search-v"
+DATABASE_FILENAME = f"{DATABASE_PREFIX}{SCHEMA_VERSION}.sqlite3"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    last_modified REAL NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_title ON notes (title COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS notes_last_modified ON notes (last_modified);
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+    title,
+    content,
+    tags,
+    tokenize = 'porter unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS note_tags (
+    tag TEXT NOT NULL,
+    note_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS note_tags_note_id ON note_tags (note_id);
+CREATE TABLE IF NOT EXISTS generation (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO generation (id, value) VALUES (0, 0);
+"""
+# The column weights (title, content, tags) match the field boosts of the
+# Whoosh index. Note: bm25() is lower for better matches.
+SCORE = "-bm25(notes_fts, 2.0, 1.0, 2.0)"
+# Highlighted terms are marked with control characters that are replaced
+# with HTML tags once the text has been escaped
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+SNIPPET_TOKENS = 32
+# Highlights are generated for this many results at a time
+RESULTS_BATCH_SIZE = 20
+
+
+class SQLiteNotes(MarkdownNotes):
+    """Notes stored as markdown files and indexed using SQLite FTS5.
+
+    When running multiple workers, every process keeps the index up to date
+    itself: SQLite serializes their writes and a note is only re-indexed if
+    it has changed since it was last indexed."""
+
+    def __init__(self):
+        super().__init__()
+        os.makedirs(self._index_path, exist_ok=True)
+        self._database_path = os.path.join(self._index_path, DATABASE_FILENAME)
+        self._remove_outdated_databases()
+        # Connections can't be shared between threads so each thread has its
+        # own. Note: A connection isn't held while yielding search results
+        # as a streamed search can continue in a different thread.
+        self._connections = threading.local()
+        self._connection().executescript(SCHEMA)
+        metrics.notes_total.set_function(self._count_notes)
+        metrics.index_size_bytes.set_function(self._index_size)
+        self._index_writer = self._load_index_writer()
+        self._watcher = self._load_watcher()
+        self._sync_index_with_retry()
+        self._index_writer.start()
+
+    def get_highlights(
+        self, term: str, titles: List[str]
+    ) -> Tuple[SearchResult, ...]:
+        """Return the search results, including highlights, for the given
+        term limited to the given note titles. Results are returned in the
+        same order as the titles and titles that don't match are omitted."""
+        self._refresh_index()
+        search_results = {
+            result.title: result
+            for result in self._iter_search(
+                term, filenames=[title + MARKDOWN_EXT for title in titles]
+            )
+        }
+        return tuple(
+            search_results[title]
+            for title in dict.fromkeys(titles)
+            if title in search_results
+        )
+
+    def get_tags(self) -> list[str]:
+        """Return a list of all tags in use."""
+        self._refresh_index()
+        return [
+            tag
+            for tag, in self._connection().execute(
+                "SELECT DISTINCT tag FROM note_tags ORDER BY tag"
+            )
+        ]
+
+    def get_tag_counts(self) -> dict[str, int]:
+        """Return the number of notes using each tag."""
+        self._refresh_index()
+        return dict(
+            self._connection().execute(
+                "SELECT tag, count(*) FROM note_tags GROUP BY tag ORDER BY tag"
+            )
+        )
+
+    def _index_generation(self) -> int:
+        return (
+            self._connection()
+            .execute("SELECT value FROM generation")
+            .fetchone()[0]
+        )
+
+    def _queue_index_changes(self, changes: Dict[str, Optional[Note]]):
+        """Queue changes made by this process, keyed by filename, to be
+        written to the index."""
+        self._index_writer.submit(changes)
+
+    def _refresh_index(self) -> None:
+        """Wait for any queued changes to be committed before the index is
+        read. If the notes directory isn't being watched, the whole directory
+        is scanned for changes first."""
+        if self._watcher is None or not self._watcher.is_alive:
+            self._index_writer.submit_full_sync()
+        if not self._index_writer.flush(timeout=self.INDEX_FLUSH_TIMEOUT):
+            logger.warning(
+                "Timed out waiting for index changes to be committed. "
+                + "Search results may be out of date."
+            )
+
+    def _iter_search(
+        self,
+        term: str,
+        sort: Literal["score", "title", "last_modified"] = "score",
+        order: Literal["asc", "desc"] = "desc",
+        limit: int = None,
+        offset: int = 0,
+        highlights: bool = True,
+        filenames: Optional[List[str]] = None,
+    ) -> Iterator[SearchResult]:
+        """Search the index for the given term, bypassing the cache and
+        optionally limited to the given note filenames."""
+        with self._search_phase("parse"):
+            term = self._pre_process_search_term(term)
+            if term == "*":
+                node = None
+            else:
+                node = parse(term)
+                if node is None:
+                    return
+            texts, tags = positive_terms(node)
+            # Results are scored and highlighted using all of the words and
+            # phrases that aren't negated
+            ranking = " OR ".join(text.fts() for text in texts) or None
+            sql, params = self._search_sql(
+                node, ranking, sort, order, limit, offset, filenames
+            )
+        with self._search_phase("search"):
+            rows = self._connection().execute(sql, params).fetchall()
+        # Bare words also match tags
+        tag_terms = tags + [
+            Tag(text.text.lower(), prefix=text.prefix)
+            for text in texts
+            if text.columns == WORD_COLUMNS
+        ]
+        # Note: Only the time spent building each result is included, not
+        # the time spent by the caller between results.
+        results_duration = 0
+        try:
+            for start in range(0, len(rows), RESULTS_BATCH_SIZE):
+                end = start + RESULTS_BATCH_SIZE
+                start_time = time.perf_counter()
+                results = self._search_results(
+                    rows[start:end],
+                    ranking if highlights else None,
+                    tag_terms,
+                    include_score=sort == "score",
+                )
+                results_duration += time.perf_counter() - start_time
+                yield from results
+        finally:
+            metrics.search_phase_duration.observe(
+                results_duration, phase="results"
+            )
+            timing.add("results", results_duration)
+
+    @staticmethod
+    def _search_sql(
+        node: Optional[Node],
+        ranking: Optional[str],
+        sort: str,
+        order: str,
+        limit: Optional[int],
+        offset: int,
+        filenames: Optional[List[str]],
+    ) -> Tuple[str, list]:
+        """Return the SQL, and its parameters, to find the id, filename, last
+        modified time and score of each note matching the given query (or
+        every note if the query is None)."""
+        columns = "n.id, n.filename, n.last_modified"
+        conditions = []
+        params = []
+        fts = None if node is None else to_fts(node)
+        if fts is not None:
+            # The whole query can be run using the FTS5 table
+            sql = (
+                f"SELECT {columns}, r.score FROM notes n JOIN ("
+                + f"SELECT rowid, {SCORE} AS score FROM notes_fts "
+                + "WHERE notes_fts MATCH ?) r ON r.rowid = n.id"
+            )
+            params.append(fts)
+        elif ranking is not None:
+            sql = (
+                f"SELECT {columns}, r.score FROM notes n LEFT JOIN ("
+                + f"SELECT rowid, {SCORE} AS score FROM notes_fts "
+                + "WHERE notes_fts MATCH ?) r ON r.rowid = n.id"
+            )
+            params.append(ranking)
+        else:
+            sql = f"SELECT {columns}, NULL AS score FROM notes n"
+        if node is not None and fts is None:
+            condition, condition_params = to_sql(node, "n.id")
+            conditions.append(f"({condition})")
+            params.extend(condition_params)
+        if filenames is not None:
+            conditions.append(
+                f"n.filename IN ({', '.join('?' * len(filenames))})"
+            )
+            params.extend(filenames)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        direction = "DESC" if order == "desc" else "ASC"
+        if sort == "title":
+            sql += f" ORDER BY n.title COLLATE NOCASE {direction}"
+        elif sort == "last_modified":
+            sql += f" ORDER BY n.last_modified {direction}"
+        else:
+            sql += f" ORDER BY score {direction}, n.title COLLATE NOCASE"
+        sql += " LIMIT ? OFFSET ?"
+        params.extend([-1 if limit is None else limit, offset])
+        return sql, params
+
+    def _search_results(
+        self,
+        rows: List[tuple],
+        ranking: Optional[str],
+        tag_terms: List[Tag],
+        include_score: bool,
+    ) -> List[SearchResult]:
+        """Return the search results for the given rows (as returned by the
+        SQL from _search_sql). If `ranking` is given, matches of it are
+        highlighted."""
+        connection = self._connection()
+        ids = [row[0] for row in rows]
+        placeholders = ", ".join("?" * len(ids))
+        highlights = {}
+        if ranking is not None:
+            # Note: Highlights are only generated for the fields that match
+            with timing.measure("highlights"):
+                for note_id, title, content in connection.execute(
+                    "SELECT rowid, highlight(notes_fts, 0, ?, ?), "
+                    + "snippet(notes_fts, 1, ?, ?, '...', ?) "
+                    + "FROM notes_fts WHERE notes_fts MATCH ? "
+                    + f"AND rowid IN ({placeholders})",
+                    [
+                        HIGHLIGHT_START,
+                        HIGHLIGHT_END,
+                        HIGHLIGHT_START,
+                        HIGHLIGHT_END,
+                        SNIPPET_TOKENS,
+                        ranking,
+                        *ids,
+                    ],
+                ):
+                    highlights[note_id] = (
+                        _highlights_html(title),
+                        _highlights_html(content),
+                    )
+        tag_matches = {}
+        if tag_terms:
+            for note_id, tag in connection.execute(
+                "SELECT note_id, tag FROM note_tags "
+                + f"WHERE note_id IN ({placeholders}) ORDER BY tag",
+                ids,
+            ):
+                if any(term.matches(tag) for term in tag_terms):
+                    tag_matches.setdefault(note_id, []).append(tag)
+        results = []
+        for note_id, filename, last_modified, score in rows:
+            title_highlights, content_highlights = highlights.get(
+                note_id, (None, None)
+            )
+            results.append(
+                SearchResult(
+                    title=self._strip_ext(filename),
+                    last_modified=last_modified,
+                    score=score if include_score else None,
+                    title_highlights=title_highlights,
+                    content_highlights=content_highlights,
+                    tag_matches=tag_matches.get(note_id),
+                )
+            )
+        return results
+
+    def _sync_index(self, optimize: bool = False, clean: bool = False) -> None:
+        """Synchronize the index with the notes directory.
+        Specify clean=True to completely rebuild the index."""
+        with metrics.index_sync_duration.time(type="full"):
+            with self._write() as connection:
+                if clean:
+                    connection.execute("DELETE FROM notes")
+                    connection.execute("DELETE FROM notes_fts")
+                    connection.execute("DELETE FROM note_tags")
+                filenames = set(self._list_all_note_filenames())
+                filenames.update(
+                    filename
+                    for filename, in connection.execute(
+                        "SELECT filename FROM notes"
+                    )
+                )
+                changed = self._sync_notes(connection, filenames)
+                if changed:
+                    self._increment_generation(connection)
+                if optimize:
+                    self._optimize(connection)
+        if changed:
+            logger.info("Index synchronized")
+
+    def _sync_index_changes(self, changes: Dict[str, Optional[Note]]) -> None:
+        """Apply the given changes, keyed by note filename, to the index in a
+        single commit. Every change, including those with the Note given, is
+        applied by synchronizing the index with the notes directory for that
+        note as the note may have changed again since."""
+        with metrics.index_sync_duration.time(type="changes"):
+            with self._write() as connection:
+                if self._sync_notes(connection, changes):
+                    self._increment_generation(connection)
+
+    def _optimize_index(self) -> None:
+        """Merge all of the full text index's b-trees into one."""
+        start_time = time.monotonic()
+        with self._write() as connection:
+            self._optimize(connection)
+        duration = time.monotonic() - start_time
+        metrics.index_sync_duration.observe(duration, type="optimize")
+        logger.info(f"Index optimized in {duration:.1f} seconds")
+
+    @staticmethod
+    def _increment_generation(connection: sqlite3.Connection) -> None:
+        """Record that the index has changed, invalidating the search cache
+        of every process."""
+        connection.execute("UPDATE generation SET value = value + 1")
+
+    @staticmethod
+    def _optimize(connection: sqlite3.Connection) -> None:
+        connection.execute(
+            "INSERT INTO notes_fts(notes_fts) VALUES ('optimize')"
+        )
+
+    def _sync_notes(self, connection: sqlite3.Connection, filenames) -> bool:
+        """Synchronize the index for each of the given note filenames. Returns
+        True if the index was changed."""
+        actions = []
+        for filename in filenames:
+            try:
+                action = self._sync_note(connection, filename)
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to index '{filename}': {e}")
+                continue
+            if action == "removed":
+                logger.info(f"'{filename}' removed from index")
+            elif action is not None:
+                logger.info(f"'{filename}' indexed")
+            if action is not None:
+                actions.append(action)
+        metrics.index_files_checked.inc(len(filenames))
+        for action in ("added", "updated", "removed"):
+            metrics.index_documents_changed.inc(
+                actions.count(action), action=action
+            )
+        return bool(actions)
+
+    def _sync_note(
+        self, connection: sqlite3.Connection, filename: str
+    ) -> Optional[str]:
+        """Synchronize the index for the given note filename. Returns
+        "added", "updated" or "removed" if the index was changed."""
+        row = connection.execute(
+            "SELECT id, mtime_ns, size FROM notes WHERE filename = ?",
+            (filename,),
+        ).fetchone()
+        try:
+            stat = os.stat(os.path.join(self.storage_path, filename))
+        except FileNotFoundError:
+            if row is None:
+                return None
+            self._remove_note_from_index(connection, row[0])
+            return "removed"
+        # Ignore already indexed e.g. by another process
+        if row is not None and row[1:] == (stat.st_mtime_ns, stat.st_size):
+            return None
+        note, stat = self._read_note(filename)
+        analysis = self._analyse_note(filename, note.content, stat)
+        values = (
+            note.title,
+            stat.st_mtime_ns / 1e9,
+            stat.st_mtime_ns,
+            stat.st_size,
+        )
+        if row is None:
+            note_id = connection.execute(
+                "INSERT INTO notes "
+                + "(filename, title, last_modified, mtime_ns, size) "
+                + "VALUES (?, ?, ?, ?, ?)",
+                (filename, *values),
+            ).lastrowid
+        else:
+            note_id = row[0]
+            connection.execute(
+                "UPDATE notes SET title = ?, last_modified = ?, "
+                + "mtime_ns = ?, size = ? WHERE id = ?",
+                (*values, note_id),
+            )
+            connection.execute(
+                "DELETE FROM notes_fts WHERE rowid = ?", (note_id,)
+            )
+            connection.execute(
+                "DELETE FROM note_tags WHERE note_id = ?", (note_id,)
+            )
+        connection.execute(
+            "INSERT INTO notes_fts (rowid, title, content, tags) "
+            + "VALUES (?, ?, ?, ?)",
+            (
+                note_id,
+                note.title,
+                analysis.content_ex_tags,
+                " ".join(analysis.tags),
+            ),
+        )
+        connection.executemany(
+            "INSERT INTO note_tags (tag, note_id) VALUES (?, ?)",
+            ((tag, note_id) for tag in analysis.tags),
+        )
+        return "added" if row is None else "updated"
+
+    @staticmethod
+    def _remove_note_from_index(
+        connection: sqlite3.Connection, note_id: int
+    ) -> None:
+        connection.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+        connection.execute("DELETE FROM notes_fts WHERE rowid = ?", (note_id,))
+        connection.execute(
+            "DELETE FROM note_tags WHERE note_id = ?", (note_id,)
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return the database connection for the current thread."""
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            # Note: Transactions are managed explicitly (see _write)
+            connection = sqlite3.connect(
+                self._database_path,
+                timeout=30,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            # Write-ahead logging allows the index to be read while it is
+            # being written to
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._connections.connection = connection
+        return connection
+
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        """Run the body of a with statement in a write transaction. Raises
+        LockError if the database is locked by another process for longer
+        than the connection's timeout (so that the change is retried)."""
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                raise LockError(str(e)) from e
+            raise
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _count_notes(self) -> int:
+        return (
+            self._connection()
+            .execute("SELECT count(*) FROM notes")
+            .fetchone()[0]
+        )
+
+    def _index_size(self) -> int:
+        """Return the total size, in bytes, of the database files."""
+        size = 0
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                size += os.path.getsize(self._database_path + suffix)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def _remove_outdated_databases(self) -> None:
+        """Delete the databases of previous schema versions."""
+        for filename in os.listdir(self._index_path):
+            if filename.startswith(
+                DATABASE_PREFIX
+            ) and not filename.startswith(DATABASE_FILENAME):
+                logger.info(f"Deleting outdated search database '{filename}'")
+                os.remove(os.path.join(self._index_path, filename))
+
+
+def _highlights_html(text: Optional[str]) -> Optional[str]:
+    """Return the given highlighted text as HTML, or None if nothing was
+    highlighted."""
+    if text is None or HIGHLIGHT_START not in text:
+        return None
+    return (
+        html.escape(text, quote=False)
+        .replace(HIGHLIGHT_START, '<strong class="match">')
+        .replace(HIGHLIGHT_END, "</strong>")
+    )
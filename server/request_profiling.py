@@ -0,0 +1,191 @@
+"""Opt-in profiling of requests using cProfile.
+
+Profiles are saved in pstats format (e.g. for use with `python -m pstats` or
+snakeviz) to a directory in which only the most recent are kept.
+
+Note: cProfile only profiles the thread it is enabled in, so a request is
+profiled on the event loop thread and, separately, in each executor thread
+it uses (see `profiled`). The profiles are combined when saved. Only one
+request is profiled at a time."""
+
+import cProfile
+import functools
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from logger import logger
+
+HEADER = "x-flatnotes-profile"
+
+
+class RequestProfile:
+    def __init__(self):
+        self._profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        """Profile the body of a with statement in the current thread."""
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def dump(self, filepath: str) -> None:
+        with self._lock:
+            profiles = list(self._profiles)
+        pstats.Stats(*profiles).dump_stats(filepath)
+
+
+_current: ContextVar[Optional[RequestProfile]] = ContextVar(
+    "flatnotes_profile", default=None
+)
+# Only one request is profiled at a time as concurrent profiles on the event
+# loop thread would interfere with each other
+_profiling_lock = threading.Lock()
+
+
+@contextmanager
+def profile_block() -> Iterator[None]:
+    """Profile the body of a with statement in the current thread if the
+    current request is being profiled."""
+    request_profile = _current.get()
+    if request_profile is None:
+        yield
+        return
+    with request_profile.profile():
+        yield
+
+
+def profiled(func: Callable) -> Callable:
+    """Wrap a function to be run in an executor thread so that it is
+    profiled, as with `profile_block`. The function must be run in a copy of
+    the request's context (see `helpers.run_in_executor`)."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile_block():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def profiled_iterator(iterator: Iterator) -> Iterator:
+    """Wrap an iterator to be iterated over in an executor thread so that
+    the work done for each item is profiled, as with `profile_block`. The
+    iterator is closed when the wrapper is."""
+    try:
+        while True:
+            with profile_block():
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles requests. If `mode` is "all", every
+    request is profiled and those that take at least `threshold` seconds are
+    saved. If `mode` is "header", only requests from authenticated users that
+    include the X-Flatnotes-Profile header are profiled, and are always
+    saved. The most recent `keep` profiles are kept in `path`."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        path: str,
+        mode: str,
+        threshold: float,
+        keep: int,
+        is_authenticated: Callable[[Request], bool],
+    ):
+        self.app = app
+        self.path = path
+        self.mode = mode
+        self.threshold = threshold
+        self.keep = keep
+        self.is_authenticated = is_authenticated
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        requested = self._is_requested(scope)
+        if not (
+            requested or self.mode == "all"
+        ) or not _profiling_lock.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+        request_profile = RequestProfile()
+        token = _current.set(request_profile)
+        start_time = time.perf_counter()
+        try:
+            with request_profile.profile():
+                await self.app(scope, receive, send)
+        finally:
+            duration = time.perf_counter() - start_time
+            _current.reset(token)
+            _profiling_lock.release()
+            if requested or duration >= self.threshold:
+                await run_in_threadpool(
+                    self._save, request_profile, scope, duration
+                )
+
+    def _is_requested(self, scope: Scope) -> bool:
+        if self.mode != "header":
+            return False
+        request = Request(scope)
+        value = request.headers.get(HEADER, "").lower()
+        return value in ("1", "true") and self.is_authenticated(request)
+
+    def _save(
+        self, request_profile: RequestProfile, scope: Scope, duration: float
+    ) -> None:
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            slug = re.sub(r"[^a-zA-Z0-9]+", "-", scope["path"]).strip("-")
+            filename = (
+                f"{datetime.now():%Y%m%dT%H%M%S%f}-{scope['method']}-"
+                + f"{slug[:50] or 'root'}-{duration * 1000:.0f}ms.prof"
+            )
+            filepath = os.path.join(self.path, filename)
+            request_profile.dump(filepath)
+            logger.info(
+                f"Saved profile of {scope['method']} {scope['path']} "
+                + f"({duration * 1000:.0f} ms) to '{filepath}'"
+            )
+            self._remove_old_profiles()
+        except OSError as e:
+            logger.error(f"Failed to save profile: {e}")
+
+    def _remove_old_profiles(self) -> None:
+        # Note: Filenames start with a timestamp so sort oldest first
+        filenames = sorted(
+            filename
+            for filename in os.listdir(self.path)
+            if filename.endswith(".prof")
+        )
+        for filename in filenames[: max(len(filenames) - self.keep, 0)]:
+            try:
+                os.remove(os.path.join(self.path, filename))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,227 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Dict, Optional, Set, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+from helpers import etag_matches, replace_base_href
+from logger import logger
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+
+class CachedFile:
+    """A static file held in memory along with its compressed variants,
+    keyed by content coding."""
+
+    def __init__(self, content: bytes, media_type: str, cache_control: str):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.variants: Dict[str, bytes] = {"identity": content}
+        self.etag = hashlib.sha256(content).hexdigest()[:16]
+
+    def add_variant(self, encoding: str, content: bytes) -> None:
+        """Add a compressed variant, if it is smaller than the original."""
+        if len(content) < len(self.variants["identity"]):
+            self.variants[encoding] = content
+
+    def etag_for(self, encoding: str) -> str:
+        # Each variant is a different representation so needs its own ETag
+        if encoding == "identity":
+            return f'"{self.etag}"'
+        return f'"{self.etag}-{encoding}"'
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """Serve a directory of static files from memory. The files are loaded
+    once at startup, along with gzip (and, if the brotli package is
+    installed, brotli) compressed variants which are served to clients that
+    accept them.
+
+    Compressed variants created at build time (e.g. "index.js.br") are used
+    in place of compressing at startup. Files in the "assets" directory
+    include a content hash in their filename so are cached by browsers
+    indefinitely.
+
+    If `path_prefix` is given, the base href of "index.html" is replaced in
+    memory. The file on disk is left as is as it is shared by every
+    worker."""
+
+    ENCODINGS = ("br", "gzip")
+    COMPRESSIBLE_TYPES = (
+        "text/",
+        "application/javascript",
+        "application/json",
+        "application/manifest+json",
+        "application/xml",
+        "image/svg+xml",
+    )
+    MIN_COMPRESS_SIZE = 1024
+    IMMUTABLE_DIRNAME = "assets"
+    IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+    DEFAULT_CACHE_CONTROL = "no-cache"
+    INDEX_FILENAME = "index.html"
+
+    def __init__(
+        self, directory: str, path_prefix: Optional[str] = None, **kwargs
+    ):
+        super().__init__(directory=directory, **kwargs)
+        self.path_prefix = path_prefix
+        self._files: Dict[str, CachedFile] = {}
+        self.load()
+
+    def load(self) -> None:
+        """(Re)load all files in the directory into memory."""
+        files = {}
+        precompressed: Dict[Tuple[str, str], bytes] = {}
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                path = os.path.relpath(filepath, self.directory)
+                path = path.replace(os.sep, "/")
+                with open(filepath, "rb") as f:
+                    content = f.read()
+                if path.endswith(".br"):
+                    precompressed[(path[:-3], "br")] = content
+                elif path.endswith(".gz"):
+                    precompressed[(path[:-3], "gzip")] = content
+                else:
+                    if (
+                        path == self.INDEX_FILENAME
+                        and self.path_prefix is not None
+                    ):
+                        content = replace_base_href(
+                            content.decode("utf-8"), self.path_prefix
+                        ).encode("utf-8")
+                    files[path] = self._cache_file(path, content)
+        if self.path_prefix is not None:
+            # Variants compressed at build time have the original base href
+            precompressed = {
+                key: content
+                for key, content in precompressed.items()
+                if key[0] != self.INDEX_FILENAME
+            }
+        for (path, encoding), content in precompressed.items():
+            if path in files:
+                files[path].add_variant(encoding, content)
+            else:
+                # Not a build time variant so serve the file as is
+                ext = ".br" if encoding == "br" else ".gz"
+                files[path + ext] = self._cache_file(path + ext, content)
+        for path, file in files.items():
+            self._compress(file, path, skip=set(precompressed))
+        self._files = files
+        logger.info(
+            f"Loaded {len(files)} static files from '{self.directory}' "
+            + f"({self._total_size('identity') // 1024} KB, "
+            + f"{self._total_size('gzip') // 1024} KB gzip"
+            + (
+                f", {self._total_size('br') // 1024} KB brotli)"
+                if brotli is not None
+                else ")"
+            )
+        )
+
+    def cached_response(self, path: str, scope: Scope) -> Response:
+        """Return a response for the file at the given path (relative to the
+        directory), negotiating the content coding from the request."""
+        file = self._files.get(path)
+        if file is None:
+            return Response(status_code=404)
+        request_headers = Headers(scope=scope)
+        encoding = self._negotiate_encoding(
+            request_headers.get("accept-encoding", ""), file
+        )
+        content = file.variants[encoding]
+        headers = {
+            "ETag": file.etag_for(encoding),
+            "Cache-Control": file.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if etag_matches(
+            request_headers.get("if-none-match"),
+            file.etag_for(encoding),
+            weak=True,
+        ):
+            return Response(status_code=304, headers=headers)
+        if scope["method"] == "HEAD":
+            headers["Content-Length"] = str(len(content))
+            content = b""
+        return Response(
+            content=content, media_type=file.media_type, headers=headers
+        )
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        # Note: `path` has already been normalised by StaticFiles
+        key = path.replace(os.sep, "/")
+        if key in self._files and scope["method"] in ("GET", "HEAD"):
+            return self.cached_response(key, scope)
+        return await super().get_response(path, scope)
+
+    def _cache_file(self, path: str, content: bytes) -> CachedFile:
+        media_type = mimetypes.guess_type(path)[0] or "text/plain"
+        if media_type.startswith("text/") and "charset" not in media_type:
+            media_type += "; charset=utf-8"
+        immutable = path.startswith(self.IMMUTABLE_DIRNAME + "/")
+        return CachedFile(
+            content,
+            media_type,
+            (
+                self.IMMUTABLE_CACHE_CONTROL
+                if immutable
+                else self.DEFAULT_CACHE_CONTROL
+            ),
+        )
+
+    def _compress(
+        self, file: CachedFile, path: str, skip: Set[Tuple[str, str]]
+    ) -> None:
+        """Add compressed variants to the file, other than those in `skip`
+        that were compressed at build time."""
+        content = file.variants["identity"]
+        if len(content) < self.MIN_COMPRESS_SIZE or not any(
+            file.media_type.startswith(t) for t in self.COMPRESSIBLE_TYPES
+        ):
+            return
+        if (path, "gzip") not in skip:
+            file.add_variant("gzip", gzip.compress(content, mtime=0))
+        if brotli is not None and (path, "br") not in skip:
+            file.add_variant("br", brotli.compress(content))
+
+    def _negotiate_encoding(
+        self, accept_encoding: str, file: CachedFile
+    ) -> str:
+        """Return the preferred content coding that both the client accepts
+        and the file has a variant for."""
+        accepted = {}
+        for item in accept_encoding.split(","):
+            coding, _, params = item.strip().partition(";")
+            quality = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    continue
+            accepted[coding.strip().lower()] = quality
+        for encoding in self.ENCODINGS:
+            quality = accepted.get(encoding, accepted.get("*", 0))
+            if encoding in file.variants and quality > 0:
+                return encoding
+        return "identity"
+
+    def _total_size(self, encoding: str) -> int:
+        return sum(
+            len(file.variants.get(encoding, file.variants["identity"]))
+            for file in self._files.values()
+        )
@@ -0,0 +1,79 @@
+"""Record the duration of each phase of a request for the Server-Timing
+response header.
+
+A route starts recording with `start()`. Phases are then measured with
+`measure()` (or added with `add()`) anywhere in the request, including in
+executor threads as long as the context is copied (see
+`helpers.run_in_executor`). Outside of a recording request, measuring a
+phase does nothing."""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+
+class Timings:
+    def __init__(self):
+        self._durations: Dict[str, float] = {}
+        self._descriptions: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, duration: float) -> None:
+        """Add the duration (in seconds) to the named phase."""
+        with self._lock:
+            self._durations[name] = self._durations.get(name, 0) + duration
+
+    def describe(self, name: str, description: str) -> None:
+        """Add a metric without a duration e.g. whether the cache was hit."""
+        with self._lock:
+            self._descriptions[name] = description
+
+    def header(self) -> str:
+        """Return the value for a Server-Timing header."""
+        with self._lock:
+            metrics = [
+                f"{name};dur={duration * 1000:.1f}"
+                for name, duration in self._durations.items()
+            ]
+            metrics.extend(
+                f'{name};desc="{description}"'
+                for name, description in self._descriptions.items()
+            )
+        return ", ".join(metrics)
+
+
+_current: ContextVar[Optional[Timings]] = ContextVar(
+    "flatnotes_timings", default=None
+)
+
+
+def start() -> Timings:
+    """Start recording phase timings for the current request."""
+    timings = Timings()
+    _current.set(timings)
+    return timings
+
+
+def add(name: str, duration: float) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, duration)
+
+
+def describe(name: str, description: str) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.describe(name, description)
+
+
+@contextmanager
+def measure(name: str) -> Iterator[None]:
+    """Add the time taken by the body of a with statement to the named
+    phase."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start_time)